@@ -0,0 +1,6 @@
+"""
+benchmarks for the channel layer and the JSON-RPC server.
+
+run them from the source directory, i.e. `python -m benchmarks.group_send`,
+every benchmark writes a JSON report that can be compared to one from an earlier run.
+"""
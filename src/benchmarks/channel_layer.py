@@ -0,0 +1,169 @@
+"""
+micro benchmarks for ZeroMqGroupLayer: round-trip latency, group fan-out, memory per channel and
+what happens at the capacity limit with every overflow policy.
+"""
+import argparse
+import asyncio
+import gc
+import resource
+import time
+import tracemalloc
+
+import zmq
+import zmq.asyncio
+
+from benchmarks.common import make_layer, shutdown_layer, write_report, percentiles, rss_bytes
+from channels_zeromq.flow import Overflow
+
+
+def prepare_context(sockets: int):
+    """
+    every channel is a SUB socket, raise the limits of zmq and the process so we can open enough of them.
+    the socket limit of a context can only be changed before its first socket is created.
+    """
+    ctx = zmq.asyncio.Context.instance()
+    ctx.set(zmq.MAX_SOCKETS, max(ctx.get(zmq.MAX_SOCKETS), sockets + 16))
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def roundtrip(count: int) -> dict:
+    """
+    send a message to a channel and wait for it, one at a time
+    """
+    layer = make_layer()
+    channel = await layer.new_channel()
+    direct = []
+    for n in range(count):
+        start = time.perf_counter()
+        await layer.send(channel, {'type': 'bench.message', 'n': n})
+        await layer.receive(channel)
+        direct.append((time.perf_counter() - start) * 1e6)
+
+    await layer.group_add('bench', channel)
+    await asyncio.sleep(0.2)
+    group = []
+    for n in range(count):
+        start = time.perf_counter()
+        await layer.group_send('bench', {'type': 'bench.message', 'n': n})
+        await layer.receive(channel)
+        group.append((time.perf_counter() - start) * 1e6)
+    shutdown_layer(layer)
+    return {'count': count, 'unit': 'us', 'send': percentiles(direct), 'group_send': percentiles(group)}
+
+
+async def fanout(members: int, messages: int) -> dict:
+    """
+    one group with many members, every message has to reach every member
+    """
+    layer = make_layer(capacity=messages + 1, channel_capacity=members + 1)
+    channels = [await layer.new_channel() for _ in range(members)]
+    for channel in channels:
+        await layer.group_add('bench', channel)
+    await asyncio.sleep(0.2 + members / 5000)
+
+    start = time.perf_counter()
+    for n in range(messages):
+        await layer.group_send('bench', {'type': 'bench.message', 'n': n})
+    received = 0
+    for channel in channels:
+        for _ in range(messages):
+            await layer.receive(channel)
+            received += 1
+    elapsed = time.perf_counter() - start
+    shutdown_layer(layer)
+    return {
+        'members': members,
+        'messages': messages,
+        'seconds': elapsed,
+        'deliveries_per_second': received / elapsed,
+        'dropped': layer.dropped(),
+    }
+
+
+async def memory(channels: int) -> dict:
+    """
+    python heap and resident memory added by opening channels and subscribing them to a group
+    """
+    layer = make_layer(channel_capacity=channels + 1)
+    gc.collect()
+    rss_before = rss_bytes()
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    names = [await layer.new_channel() for _ in range(channels)]
+    for name in names:
+        await layer.group_add('bench', name)
+    await asyncio.sleep(0.1)
+    gc.collect()
+    snapshot_after = tracemalloc.take_snapshot()
+    rss_after = rss_bytes()
+    tracemalloc.stop()
+    heap = sum(stat.size_diff for stat in snapshot_after.compare_to(snapshot_before, 'filename'))
+    shutdown_layer(layer)
+    return {
+        'channels': channels,
+        'python_bytes_per_channel': heap / channels,
+        'rss_bytes_per_channel': (rss_after - rss_before) / channels,
+    }
+
+
+async def capacity(capacity: int) -> dict:
+    """
+    send twice the capacity to a channel that nobody reads, for every overflow policy
+    """
+    results = {}
+    for policy in Overflow:
+        layer = make_layer(capacity=capacity, overflow=policy, overflow_timeout=0.001)
+        channel = await layer.new_channel()
+        accepted = 0
+        start = time.perf_counter()
+        for n in range(capacity * 2):
+            if await layer.channels[channel].send(f'{{"type": "bench.message", "n": {n}}}'):
+                accepted += 1
+        elapsed = time.perf_counter() - start
+        queued = layer.channels[channel].queue.qsize()
+        results[policy.value] = {
+            'sent': capacity * 2,
+            'accepted': accepted,
+            'queued': queued,
+            'dropped': sum(layer.channels[channel].dropped.values()),
+            'congested': layer.backpressure(channel).is_set(),
+            'us_per_send': elapsed / (capacity * 2) * 1e6,
+        }
+        shutdown_layer(layer)
+    return {'capacity': capacity, 'policies': results}
+
+
+async def run(args) -> dict:
+    results = {}
+    if 'roundtrip' in args.only:
+        results['roundtrip'] = await roundtrip(args.count)
+    if 'fanout' in args.only:
+        results['fanout'] = [await fanout(members, args.messages) for members in args.members]
+    if 'memory' in args.only:
+        results['memory'] = await memory(args.memory_channels)
+    if 'capacity' in args.only:
+        results['capacity'] = await capacity(args.capacity)
+    return results
+
+
+BENCHMARKS = ['roundtrip', 'fanout', 'memory', 'capacity']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--count', type=int, default=5000, help='round trips to measure')
+    parser.add_argument('--members', type=int, nargs='+', default=[1, 100, 10000], help='group sizes for fan-out')
+    parser.add_argument('--messages', type=int, default=100, help='messages per fan-out run')
+    parser.add_argument('--memory-channels', type=int, default=1000)
+    parser.add_argument('--capacity', type=int, default=1000)
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    args = parser.parse_args()
+    prepare_context(max(args.members + [args.memory_channels]) + 8)
+    write_report('channel_layer', asyncio.run(run(args)), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sonne.settings')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def write_report(name: str, results: dict, path: str = None) -> Path:
+    """
+    write the results of a benchmark run together with enough metadata to compare it against other runs
+    """
+    report = {
+        'benchmark': name,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if path is None:
+        path = f'bench-{name}-{time.strftime("%Y%m%d-%H%M%S")}.json'
+    path = Path(path)
+    path.write_text(json.dumps(report, indent=2))
+    print(json.dumps(results, indent=2))
+    print(f'report written to {path}', file=sys.stderr)
+    return path
+
+
+def make_layer(**config):
+    """
+    a channel layer with its own inproc endpoint, so several layers can live in one process.
+    must be called with a running event loop.
+    """
+    from channels_zeromq.core import ZeroMqGroupLayer
+    config.setdefault('host', f'inproc://bench-{uuid.uuid4().hex}')
+    return ZeroMqGroupLayer(**config)
+
+
+def shutdown_layer(layer):
+    """
+    tear down a layer without terminating the shared zmq context
+    """
+    layer.publisher.task.cancel()
+    layer.publisher.socket.close(linger=0)
+    for chn in layer.channels.values():
+        chn.task.cancel()
+        chn.socket.close(linger=0)
+
+
+def percentiles(samples, points=(50, 95, 99)) -> dict:
+    """
+    nearest-rank percentiles and the max, in the unit of the samples
+    """
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    result = {f'p{p}': ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+    result['max'] = ordered[-1]
+    result['mean'] = sum(ordered) / len(ordered)
+    return result
+
+
+def rss_bytes(pid='self') -> int:
+    """
+    resident set size of a process, linux only
+    """
+    with open(f'/proc/{pid}/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
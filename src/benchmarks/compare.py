@@ -0,0 +1,44 @@
+"""
+compare two benchmark reports: prints every numeric result of both runs side by side with the relative change.
+"""
+import argparse
+import json
+
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f'{prefix}.{key}' if prefix else str(key))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            yield from flatten(item, f'{prefix}[{index}]')
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=5.0, help='only show changes above this many percent')
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline['benchmark'] != candidate['benchmark']:
+        parser.error(f'reports are from different benchmarks: {baseline["benchmark"]}, {candidate["benchmark"]}')
+
+    print(f'{baseline["revision"] or "baseline"} -> {candidate["revision"] or "candidate"}')
+    old = dict(flatten(baseline['results']))
+    for key, new_value in flatten(candidate['results']):
+        if key not in old:
+            continue
+        old_value = old[key]
+        change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+        if abs(change) >= args.threshold:
+            print(f'{key:60s} {old_value:14.3f} {new_value:14.3f} {change:+8.1f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+bytes on the wire vs CPU time of the response compressions, for solr_select-like responses of growing size.
+"""
+import argparse
+import json
+import time
+import zlib
+
+from benchmarks.common import write_report
+from benchmarks.fake_solr import make_doc
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def codecs(levels):
+    found = {}
+    for level in levels['deflate']:
+        found[f'deflate-{level}'] = (lambda l: lambda data: zlib.compress(data, l))(level)
+    if zstandard is not None:
+        for level in levels['zstd']:
+            found[f'zstd-{level}'] = (lambda l: lambda data: zstandard.ZstdCompressor(level=l).compress(data))(level)
+    return found
+
+
+def response(docs: int, doc_size: int) -> bytes:
+    result = {'responseHeader': {'status': 0}, 'response': {'numFound': docs, 'start': 0,
+                                                            'docs': [make_doc(n, doc_size) for n in range(docs)]}}
+    return json.dumps({'jsonrpc': '2.0', 'id': 1, 'result': result}).encode()
+
+
+def measure(codec, data: bytes, repeat: int) -> dict:
+    start = time.process_time()
+    for _ in range(repeat):
+        compressed = codec(data)
+    cpu = (time.process_time() - start) / repeat
+    return {
+        'bytes': len(compressed),
+        'ratio': len(data) / len(compressed),
+        'cpu_ms': cpu * 1000,
+        'mb_per_cpu_second': len(data) / cpu / 1e6 if cpu else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--doc-size', type=int, default=300, help='bytes of filler text per document')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    args = parser.parse_args()
+    found = codecs({'deflate': [1, 6, 9], 'zstd': [1, 3, 9]})
+    results = []
+    for docs in args.docs:
+        data = response(docs, args.doc_size)
+        results.append({
+            'docs': docs,
+            'bytes': len(data),
+            'codecs': {name: measure(codec, data, args.repeat) for name, codec in found.items()},
+        })
+    write_report('compression', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
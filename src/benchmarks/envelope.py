@@ -0,0 +1,93 @@
+"""
+cost of encoding JSON-RPC responses for growing results: the old dataclass envelope that was copied with
+dataclasses.asdict before encoding, the slotted envelopes that encode their result as it is, and a raw solr
+body spliced into the envelope.
+"""
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict
+from typing import Any, Union
+
+from benchmarks.common import write_report, percentiles
+
+
+@dataclass
+class DataclassResponse:
+    result: dict
+    id: Union[str, int]
+    jsonrpc: str = '2.0'
+
+
+def solr_result(docs: int) -> dict:
+    return {'responseHeader': {'status': 0, 'QTime': 3}, 'response': {'numFound': docs, 'start': 0, 'docs': [
+        {'id': f'doc-{n}', 'title': f'a title of document {n}', 'author': ['someone', 'someone else'],
+         'year': 2000 + n % 20, 'cited_by': list(range(n % 30))}
+        for n in range(docs)
+    ]}}
+
+
+async def timed(encode, rounds: int) -> dict:
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        await encode()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return percentiles(samples)
+
+
+async def peak(encode) -> int:
+    tracemalloc.start()
+    try:
+        await encode()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+async def measure(docs: int, rounds: int) -> dict:
+    from solr_channel.consumers.JsonRpcConsumer import JsonRpcResultResponse, RawJson
+    result = solr_result(docs)
+    body = json.dumps(result)
+
+    async def dataclass_envelope():
+        return json.dumps(asdict(DataclassResponse(result, 'rq-1')))
+
+    async def slotted_envelope():
+        return await JsonRpcResultResponse(result, 'rq-1').encode()
+
+    async def raw_envelope():
+        return await JsonRpcResultResponse(RawJson(body), 'rq-1').encode()
+
+    variants = {'dataclass': dataclass_envelope, 'slotted': slotted_envelope, 'raw': raw_envelope}
+    return {
+        'docs': docs,
+        'bytes': len(body),
+        'unit': 'us',
+        **{name: {**await timed(encode, rounds), 'peak_bytes': await peak(encode)}
+           for name, encode in variants.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, nargs='+', default=[1, 10, 100, 1000, 10000], help='documents per result')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    args = parser.parse_args()
+
+    # encode inline, the thread hand-off of large results is measured by benchmarks.json_offload
+    from channels_zeromq.codec import JsonCodec
+    from solr_channel.lib import jsoncodec
+    jsoncodec._codec = JsonCodec(None)
+
+    async def run():
+        return [await measure(docs, max(5, args.rounds * 10 // max(10, docs))) for docs in args.docs]
+
+    write_report('envelope', {'results': asyncio.run(run())}, args.output)
+
+
+if __name__ == '__main__':
+    main()
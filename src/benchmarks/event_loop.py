@@ -0,0 +1,169 @@
+"""
+the default asyncio loop against uvloop: callback and task switching throughput, TCP echo round trips,
+channel layer round trips, and the loop lag measured by solr_channel.lib.looplag while many connections are busy.
+every loop runs in its own interpreter, a loop policy can't be swapped cleanly inside one process.
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+from benchmarks.common import write_report, percentiles
+
+
+async def callbacks(count: int) -> dict:
+    loop = asyncio.get_event_loop()
+    done = loop.create_future()
+    remaining = [count]
+
+    def callback():
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            done.set_result(None)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        loop.call_soon(callback)
+    await done
+    elapsed = time.perf_counter() - start
+    return {'count': count, 'per_second': count / elapsed}
+
+
+async def task_switches(count: int) -> dict:
+    """
+    two tasks passing a token back and forth through queues, like a consumer and the channel layer
+    """
+    ping, pong = asyncio.Queue(), asyncio.Queue()
+
+    async def echo():
+        for _ in range(count):
+            await pong.put(await ping.get())
+
+    task = asyncio.ensure_future(echo())
+    start = time.perf_counter()
+    for n in range(count):
+        await ping.put(n)
+        await pong.get()
+    elapsed = time.perf_counter() - start
+    await task
+    return {'count': count, 'us_per_roundtrip': elapsed / count * 1e6}
+
+
+async def _echo(reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            writer.write(line)
+    finally:
+        writer.close()
+
+
+async def tcp_echo(connections: int, messages: int, size: int) -> dict:
+    """
+    many connections doing request/response round trips over loopback at the same time
+    """
+    server = await asyncio.start_server(_echo, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    payload = b'x' * (size - 1) + b'\n'
+    samples = []
+
+    async def client():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for _ in range(messages):
+            start = time.perf_counter()
+            writer.write(payload)
+            await reader.readline()
+            samples.append((time.perf_counter() - start) * 1e6)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(connections)])
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    return {
+        'connections': connections,
+        'messages': messages,
+        'size': size,
+        'roundtrips_per_second': len(samples) / elapsed,
+        'latency_us': percentiles(samples),
+    }
+
+
+async def layer_roundtrip(count: int) -> dict:
+    from benchmarks.channel_layer import roundtrip
+    return await roundtrip(count)
+
+
+async def lag_under_load(connections: int, messages: int, size: int) -> dict:
+    """
+    the loop lag monitor running next to the TCP echo load
+    """
+    from solr_channel.lib.looplag import LagMonitor
+    monitor = LagMonitor(interval=0.01, threshold=0.05, window=100000)
+    monitor.start()
+    await asyncio.sleep(0.1)
+    await tcp_echo(connections, messages, size)
+    monitor.stop()
+    return {'unit': 's', 'lag': monitor.percentiles(), 'stalls': len(monitor.stalls)}
+
+
+async def measure(args) -> dict:
+    results = {}
+    if 'callbacks' in args.only:
+        results['callbacks'] = await callbacks(args.count * 20)
+    if 'tasks' in args.only:
+        results['tasks'] = await task_switches(args.count)
+    if 'tcp' in args.only:
+        results['tcp'] = await tcp_echo(args.connections, args.messages, args.size)
+    if 'layer' in args.only:
+        results['layer'] = await layer_roundtrip(args.count)
+    if 'lag' in args.only:
+        results['lag'] = await lag_under_load(args.connections, args.messages, args.size)
+    return results
+
+
+def child(args):
+    from sonne.serve import install_loop_policy
+    install_loop_policy(args.child)
+    results = asyncio.get_event_loop().run_until_complete(measure(args))
+    print(json.dumps(results))
+
+
+BENCHMARKS = ['callbacks', 'tasks', 'tcp', 'layer', 'lag']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--loops', nargs='+', choices=['asyncio', 'uvloop'], default=['asyncio', 'uvloop'])
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--count', type=int, default=20000, help='round trips for the task and layer benchmarks')
+    parser.add_argument('--connections', type=int, default=200, help='concurrent TCP connections')
+    parser.add_argument('--messages', type=int, default=200, help='round trips per TCP connection')
+    parser.add_argument('--size', type=int, default=1024, help='bytes per TCP message')
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    results = {}
+    for loop in args.loops:
+        argv = [sys.executable, '-m', 'benchmarks.event_loop', '--child', loop, '--only', *args.only,
+                '--count', str(args.count), '--connections', str(args.connections),
+                '--messages', str(args.messages), '--size', str(args.size)]
+        process = subprocess.run(argv, capture_output=True, text=True)
+        if process.returncode != 0:
+            print(process.stderr, file=sys.stderr)
+            results[loop] = {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else ''}
+            continue
+        results[loop] = json.loads(process.stdout.strip().splitlines()[-1])
+    write_report('event_loop', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
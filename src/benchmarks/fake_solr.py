@@ -0,0 +1,102 @@
+"""
+a stand-in for solr that answers the endpoints used by JsonRpcSolrPassthrough with generated documents,
+after a configurable delay. run it with `python -m benchmarks.fake_solr --port 8983`.
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+
+def make_doc(n: int, size: int) -> dict:
+    return {
+        'id': f'doc{n}',
+        'title': f'a generated title for document {n}',
+        'author': [f'Author {n % 97}', f'Author {n % 89}'],
+        'author_count': 2,
+        'year': 1990 + n % 30,
+        'cited_by_count': n % 50,
+        'abstract': 'x' * size,
+    }
+
+
+class FakeSolr:
+    def __init__(self, latency: float, jitter: float, docs: int, doc_size: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.docs = docs
+        self.doc_size = doc_size
+        self.requests = 0
+        # the documents are the same for every request, only encode them once
+        self.select_body = json.dumps({
+            'responseHeader': {'status': 0, 'QTime': 1},
+            'response': {'numFound': docs * 10, 'start': 0,
+                         'docs': [make_doc(n, doc_size) for n in range(docs)]},
+        })
+        self.get_body = json.dumps({'doc': make_doc(0, doc_size)})
+        self.stream_body = json.dumps({'result-set': {'docs': [
+            {'count(*)': 10, 'position': 1, 'senior_count': 2},
+            {'count(*)': 4, 'position': 2, 'senior_count': 4},
+            {'EOF': True, 'RESPONSE_TIME': 5},
+        ]}})
+        # the authors of make_doc, for the suggest_author index
+        self.facet_body = json.dumps({
+            'responseHeader': {'status': 0, 'QTime': 1},
+            'response': {'numFound': docs * 10, 'start': 0, 'docs': []},
+            'facets': {'count': docs * 10, 'authors': {'buckets': [
+                {'val': f'Author {n}', 'count': 100 - n} for n in range(97)
+            ]}},
+        })
+
+    async def delay(self):
+        self.requests += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    async def get(self, request):
+        await self.delay()
+        return web.Response(text=self.get_body, content_type='application/json')
+
+    async def select(self, request):
+        await self.delay()
+        if request.body_exists and 'facet' in await request.json():
+            return web.Response(text=self.facet_body, content_type='application/json')
+        return web.Response(text=self.select_body, content_type='application/json')
+
+    async def stream(self, request):
+        await self.delay()
+        return web.Response(text=self.stream_body, content_type='application/json')
+
+    async def system_info(self, request):
+        return web.json_response({'responseHeader': {'status': 0}})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/solr/admin/info/system', self.system_info)
+        app.router.add_route('*', '/api/c/{collection}/get', self.get)
+        app.router.add_route('*', '/api/c/{collection}/select', self.select)
+        app.router.add_route('*', '/solr/{collection}/select', self.select)
+        app.router.add_route('*', '/solr/{collection}/stream', self.stream)
+        return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--solr-latency', type=float, default=0.01, help='mean response delay in seconds')
+    parser.add_argument('--solr-jitter', type=float, default=0.002, help='standard deviation of the delay')
+    parser.add_argument('--solr-docs', type=int, default=10, help='documents per select response')
+    parser.add_argument('--solr-doc-size', type=int, default=500, help='bytes of filler text per document')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8983)
+    add_arguments(parser)
+    args = parser.parse_args()
+    solr = FakeSolr(args.solr_latency, args.solr_jitter, args.solr_docs, args.solr_doc_size)
+    web.run_app(solr.app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
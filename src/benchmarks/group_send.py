@@ -0,0 +1,64 @@
+"""
+group_send throughput: how many messages per second make it from group_send to a subscribed channel.
+single runs vary a lot, compare the medians of several rounds.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from benchmarks.common import make_layer, shutdown_layer, write_report
+
+
+async def group_send_throughput(messages: int, members: int) -> dict:
+    layer = make_layer(capacity=messages + 1, channel_capacity=members + 1)
+    channels = [await layer.new_channel() for _ in range(members)]
+    for channel in channels:
+        await layer.group_add('bench', channel)
+    # zmq subscriptions are asynchronous, give them a moment to reach the publisher
+    await asyncio.sleep(0.2)
+
+    start = time.perf_counter()
+    for n in range(messages):
+        await layer.group_send('bench', {'type': 'bench.message', 'n': n})
+    sent = time.perf_counter()
+    for channel in channels:
+        for _ in range(messages):
+            await layer.receive(channel)
+    done = time.perf_counter()
+
+    shutdown_layer(layer)
+    return {
+        'messages': messages,
+        'members': members,
+        'send_seconds': sent - start,
+        'total_seconds': done - start,
+        'sent_per_second': messages / (sent - start),
+        'delivered_per_second': messages * members / (done - start),
+    }
+
+
+async def rounds(messages: int, members: int, count: int) -> dict:
+    runs = [await group_send_throughput(messages, members) for _ in range(count)]
+    return {
+        'messages': messages,
+        'members': members,
+        'sent_per_second': statistics.median(run['sent_per_second'] for run in runs),
+        'delivered_per_second': statistics.median(run['delivered_per_second'] for run in runs),
+        'rounds': runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--members', type=int, default=1)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    args = parser.parse_args()
+    result = asyncio.run(rounds(args.messages, args.members, args.rounds))
+    write_report('group_send', result, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+latency of small requests while large results are encoded and decoded on the same event loop,
+with everything inline against offloading large payloads, see channels_zeromq.codec.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import write_report, percentiles
+from channels_zeromq.codec import JsonCodec, DEFAULT_THRESHOLD
+
+
+def solr_result(docs: int, size: int) -> dict:
+    return {'jsonrpc': '2.0', 'id': 1, 'result': {'response': {'numFound': docs, 'start': 0, 'docs': [
+        {'id': f'doc-{n}', 'title': 'x' * size, 'author': ['someone', 'someone else'], 'year': 2000 + n % 20}
+        for n in range(docs)
+    ]}}}
+
+
+SMALL = {'jsonrpc': '2.0', 'id': 2, 'result': {'response': {'numFound': 1, 'docs': [{'id': 'doc-0'}]}}}
+
+
+async def run(codec: JsonCodec, large: dict, workers: int, interval: float, seconds: float) -> dict:
+    stop = time.perf_counter() + seconds
+    large_text = json.dumps(large)
+    small_text = json.dumps(SMALL)
+    samples = []
+    large_done = [0]
+
+    async def large_worker():
+        while time.perf_counter() < stop:
+            await codec.dumps(large)
+            await codec.loads(large_text)
+            large_done[0] += 1
+            # the next request, it does not arrive back to back
+            await asyncio.sleep(0)
+
+    async def small_client():
+        while time.perf_counter() < stop:
+            due = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            await codec.loads(small_text)
+            await codec.dumps(SMALL)
+            samples.append((time.perf_counter() - due) * 1e3)
+
+    await asyncio.gather(small_client(), *[large_worker() for _ in range(workers)])
+    return {
+        'threshold': codec.threshold,
+        'small_latency_ms': percentiles(samples, (50, 90, 99)),
+        'small_requests': len(samples),
+        'large_per_second': large_done[0] / seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, default=20000, help='documents in a large result')
+    parser.add_argument('--doc-size', type=int, default=200, help='characters per document')
+    parser.add_argument('--workers', type=int, default=2, help='large requests in flight')
+    parser.add_argument('--interval', type=float, default=0.005, help='seconds between small requests')
+    parser.add_argument('--seconds', type=float, default=10.0, help='duration of each run')
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    args = parser.parse_args()
+
+    large = solr_result(args.docs, args.doc_size)
+    results = {'large_bytes': len(json.dumps(large))}
+    for mode, threshold in (('inline', None), ('offload', args.threshold)):
+        results[mode] = asyncio.run(run(JsonCodec(threshold), large, args.workers, args.interval, args.seconds))
+    write_report('json_offload', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
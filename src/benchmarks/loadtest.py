@@ -0,0 +1,223 @@
+"""
+end-to-end load test of ws/rpc/solr/: starts benchmarks.fake_solr and daphne with sonne.asgi:application,
+then lets many simulated JSON-RPC clients hammer the server and reports latency percentiles per method,
+throughput and the resident memory of the server.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from benchmarks import fake_solr
+from benchmarks.common import write_report, percentiles, rss_bytes
+
+WORKLOAD = {
+    'solr_get': (0.5, lambda n: {'collection': 'bench', 'id': f'doc{n}'}),
+    'solr_select': (0.4, lambda n: {'collection': 'bench', 'payload': {'query': f'title:{n}', 'limit': 10}}),
+    'solr_author_position': (0.1, lambda n: {'collection': 'bench', 'author': f'Author {n % 97}', 'rows': 100}),
+}
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{process.args} exited with {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'nothing is listening on port {port} after {timeout}s')
+
+
+class Stack:
+    """
+    fake solr and daphne as child processes, so their CPU time does not compete with the clients' event loop
+    """
+
+    def __init__(self, port: int, solr_port: int, solr_args: list, loop: str = 'asyncio'):
+        self.port = port
+        self.loop = loop
+        self.solr_port = solr_port
+        self.solr_args = solr_args
+        self.solr = None
+        self.daphne = None
+
+    def __enter__(self):
+        self.solr = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_solr', '--port', str(self.solr_port),
+                                      *self.solr_args])
+        wait_for_port(self.solr_port, self.solr)
+        env = dict(os.environ, SONNE_SOLR_HOST=f'http://127.0.0.1:{self.solr_port}', SONNE_EVENT_LOOP=self.loop)
+        self.daphne = subprocess.Popen([sys.executable, '-m', 'sonne.serve', '-b', '127.0.0.1', '-p', str(self.port),
+                                        'sonne.asgi:application'], env=env)
+        wait_for_port(self.port, self.daphne)
+        return self
+
+    def __exit__(self, *exc):
+        for process in (self.daphne, self.solr):
+            if process is not None:
+                process.terminate()
+                process.wait(10)
+
+    @property
+    def url(self):
+        return f'ws://127.0.0.1:{self.port}/ws/rpc/solr/'
+
+
+class RpcClient:
+    """
+    one websocket connection, requests are matched to their responses by id
+    """
+    ids = itertools.count()
+
+    def __init__(self, ws: aiohttp.ClientWebSocketResponse):
+        self.ws = ws
+        self.pending = {}
+        self.reader = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        async for msg in self.ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            response = msg.json()
+            future = self.pending.pop(response.get('id'), None)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+    async def call(self, method: str, params: dict, timeout: float) -> dict:
+        rqid = next(self.ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[rqid] = future
+        await self.ws.send_json({'jsonrpc': '2.0', 'method': method, 'id': rqid, 'params': params})
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(rqid, None)
+
+    async def close(self):
+        await self.ws.close()
+        self.reader.cancel()
+
+
+class Results:
+    def __init__(self):
+        self.latency = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.rss = []
+
+    def record(self, method: str, seconds: float, response: dict = None):
+        if response is None:
+            self.errors[f'{method}: timeout'] += 1
+        elif 'error' in response:
+            self.errors[f'{method}: {response["error"].get("message")}'] += 1
+        else:
+            self.latency[method].append(seconds * 1000)
+
+
+def pick_method(rng: random.Random) -> str:
+    methods = list(WORKLOAD)
+    return rng.choices(methods, weights=[WORKLOAD[m][0] for m in methods])[0]
+
+
+async def simulate_client(session, url, results: Results, requests: int, think: float, timeout: float,
+                          connect_slots: asyncio.Semaphore, seed: int):
+    rng = random.Random(seed)
+    async with connect_slots:
+        try:
+            ws = await session.ws_connect(url)
+        except aiohttp.ClientError as e:
+            results.errors[f'connect: {type(e).__name__}'] += 1
+            return
+    client = RpcClient(ws)
+    try:
+        for _ in range(requests):
+            method = pick_method(rng)
+            params = WORKLOAD[method][1](rng.randrange(1000))
+            start = time.perf_counter()
+            try:
+                response = await client.call(method, params, timeout)
+            except asyncio.TimeoutError:
+                response = None
+            results.record(method, time.perf_counter() - start, response)
+            if think:
+                await asyncio.sleep(rng.expovariate(1 / think))
+    finally:
+        await client.close()
+
+
+async def sample_rss(pid: int, results: Results, interval=0.5):
+    while True:
+        try:
+            results.rss.append(rss_bytes(pid))
+        except OSError:
+            return
+        await asyncio.sleep(interval)
+
+
+async def drive(url: str, pid: int, clients: int, requests: int, think: float, timeout: float,
+                connect_concurrency: int) -> dict:
+    results = Results()
+    sampler = asyncio.ensure_future(sample_rss(pid, results))
+    connect_slots = asyncio.Semaphore(connect_concurrency)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            simulate_client(session, url, results, requests, think, timeout, connect_slots, seed)
+            for seed in range(clients)
+        ])
+        elapsed = time.perf_counter() - start
+    sampler.cancel()
+    completed = sum(len(samples) for samples in results.latency.values())
+    return {
+        'clients': clients,
+        'requests_per_client': requests,
+        'seconds': elapsed,
+        'completed': completed,
+        'requests_per_second': completed / elapsed,
+        'errors': dict(results.errors),
+        'latency_ms': {method: percentiles(samples) for method, samples in results.latency.items()},
+        'latency_ms_all': percentiles([s for samples in results.latency.values() for s in samples]),
+        'server_rss_bytes': {'max': max(results.rss, default=0), 'last': results.rss[-1] if results.rss else 0},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=20, help='requests per client')
+    parser.add_argument('--think', type=float, default=0.05, help='mean pause between requests of a client')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--connect-concurrency', type=int, default=100, help='websocket handshakes in flight')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--solr-port', type=int, default=8983)
+    parser.add_argument('--loop', default='asyncio', choices=['asyncio', 'uvloop'], help='event loop of the server')
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    fake_solr.add_arguments(parser)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    solr_args = ['--solr-latency', str(args.solr_latency), '--solr-jitter', str(args.solr_jitter),
+                 '--solr-docs', str(args.solr_docs), '--solr-doc-size', str(args.solr_doc_size)]
+    with Stack(args.port, args.solr_port, solr_args, args.loop) as stack:
+        result = asyncio.run(drive(stack.url, stack.daphne.pid, args.clients, args.requests, args.think,
+                                   args.timeout, args.connect_concurrency))
+    result['loop'] = args.loop
+    result['solr'] = {'latency': args.solr_latency, 'docs': args.solr_docs, 'doc_size': args.solr_doc_size}
+    write_report('loadtest', result, args.output)
+
+
+if __name__ == '__main__':
+    main()
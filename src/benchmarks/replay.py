@@ -0,0 +1,226 @@
+"""
+replays requests recorded by solr_channel.lib.recorder (settings.RECORDER) against daphne with benchmarks.fake_solr,
+or against a running server with --url. every recorded connection gets its own websocket and sends its requests
+at the recorded pace, scaled by --speed, without waiting for the responses. reports the latency per method and
+how far the replay fell behind the schedule.
+
+a request that uses an id the server created, i.e. solr_cursor_next with the cursor of a solr_cursor_open, waits
+for the response of the request that created it and gets the id the replay server returned instead of the recorded
+one. requests whose id was not created by a recorded request of their connection are skipped and reported.
+"""
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import resource
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from benchmarks import fake_solr
+from benchmarks.common import write_report, percentiles
+from benchmarks.loadtest import Results, RpcClient, Stack, sample_rss
+
+
+# the params that hold an id the server created, and the key of the result the id was returned under
+ID_PARAMS = {'cursor': 'cursor', 'subscription': 'subscription', 'graph_id': 'uuid'}
+
+
+def load(paths: List[str], methods: List[str] = None, limit: int = None) -> List[dict]:
+    """
+    the requests of all logs, i.e. one per worker, ordered by the time they were received.
+    the ids their results created are added to them as "o".
+    """
+    requests = []
+    created = {}
+    for path in paths:
+        with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path)) as lines:
+            for line in lines:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if 'o' in entry:
+                    created.setdefault((entry['c'], entry['i']), entry['o'])
+                elif methods is None or entry['m'] in methods:
+                    requests.append(entry)
+    for request in requests:
+        request['o'] = created.get((request['c'], request.get('i')), {})
+    requests.sort(key=lambda request: request['t'])
+    return requests[:limit]
+
+
+# the request that created the id, the key of the id in its result and the param it goes into
+Dependency = Tuple[int, str, str]
+# a request that uses an id nobody in the replay creates
+MISSING = (-1, '', '')
+
+
+def link(requests: List[dict]) -> List[Optional[Dependency]]:
+    """
+    the dependency of every request of a connection, None if it needs no id of the server
+    """
+    creators = {}
+    dependencies = []
+    for n, request in enumerate(requests):
+        dependency = None
+        for param, key in ID_PARAMS.items():
+            value = request['p'].get(param) if isinstance(request['p'], dict) else None
+            if value is not None:
+                dependency = (creators[key, value], key, param) if (key, value) in creators else MISSING
+                break
+        dependencies.append(dependency)
+        for key, value in request['o'].items():
+            creators.setdefault((key, value), n)
+    return dependencies
+
+
+def by_connection(requests: List[dict]) -> Dict[str, List[dict]]:
+    connections = {}
+    for request in requests:
+        connections.setdefault(request['c'], []).append(request)
+    return connections
+
+
+class Schedule:
+    """
+    maps recorded times to replay times
+    """
+
+    def __init__(self, first: float, speed: float):
+        self.first = first
+        self.speed = speed
+        self.start = time.perf_counter()
+        self.late = []
+
+    async def wait(self, recorded: float):
+        if not self.speed:
+            return
+        delay = self.start + (recorded - self.first) / self.speed - time.perf_counter()
+        if 0 < delay:
+            await asyncio.sleep(delay)
+        else:
+            self.late.append(-delay * 1000)
+
+
+async def timed_call(client: RpcClient, method: str, params: dict, results: Results, timeout: float):
+    start = time.perf_counter()
+    try:
+        response = await client.call(method, params, timeout)
+    except asyncio.TimeoutError:
+        response = None
+    results.record(method, time.perf_counter() - start, response)
+    return response
+
+
+async def replay_connection(session, url: str, requests: List[dict], schedule: Schedule, results: Results,
+                            skipped: Counter, timeout: float):
+    dependencies = link(requests)
+    await schedule.wait(requests[0]['t'])
+    try:
+        ws = await session.ws_connect(url)
+    except aiohttp.ClientError as e:
+        results.errors[f'connect: {type(e).__name__}'] += 1
+        return
+    client = RpcClient(ws)
+    calls: List[asyncio.Future] = []
+
+    async def call(request: dict, dependency: Optional[Dependency]) -> Optional[dict]:
+        params = request['p']
+        if dependency is not None:
+            creator, key, param = dependency
+            # the creating request may still be waiting for its response
+            response = await calls[creator] if dependency is not MISSING else None
+            result = (response or {}).get('result')
+            if not isinstance(result, dict) or key not in result:
+                skipped[request['m']] += 1
+                return None
+            params = {**params, param: result[key]}
+        return await timed_call(client, request['m'], params, results, timeout)
+
+    try:
+        for request, dependency in zip(requests, dependencies):
+            await schedule.wait(request['t'])
+            calls.append(asyncio.ensure_future(call(request, dependency)))
+            if not schedule.speed:
+                # as fast as possible, one request after the other
+                await calls[-1]
+        await asyncio.gather(*calls)
+    finally:
+        await client.close()
+
+
+async def replay(url: str, pid: int, requests: List[dict], speed: float, timeout: float) -> dict:
+    results = Results()
+    skipped = Counter()
+    connections = by_connection(requests)
+    sampler = asyncio.ensure_future(sample_rss(pid, results)) if pid else None
+    schedule = Schedule(requests[0]['t'], speed)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[
+            replay_connection(session, url, connection, schedule, results, skipped, timeout)
+            for connection in connections.values()
+        ])
+    elapsed = time.perf_counter() - schedule.start
+    if sampler is not None:
+        sampler.cancel()
+    completed = sum(len(samples) for samples in results.latency.values())
+    return {
+        'requests': len(requests),
+        'connections': len(connections),
+        'speed': speed,
+        'recorded_seconds': requests[-1]['t'] - requests[0]['t'],
+        'seconds': elapsed,
+        'completed': completed,
+        'requests_per_second': completed / elapsed,
+        'errors': dict(results.errors),
+        # requests that use an id that no replayed request created, or whose creating request failed
+        'skipped': dict(skipped),
+        'latency_ms': {method: percentiles(samples) for method, samples in results.latency.items()},
+        'latency_ms_all': percentiles(list(itertools.chain.from_iterable(results.latency.values()))),
+        # requests sent later than scheduled, many of them mean the replay could not keep up
+        'behind_schedule': {'requests': len(schedule.late), 'ms': percentiles(schedule.late)},
+        'server_rss_bytes': {'max': max(results.rss, default=0), 'last': results.rss[-1] if results.rss else 0},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('logs', nargs='+', help='request logs written by the recorder, may be gzipped')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='2 replays twice as fast as recorded, 0 sends the requests of a connection back to back')
+    parser.add_argument('--methods', nargs='+', default=None, help='only replay these methods')
+    parser.add_argument('--limit', type=int, default=None, help='only replay the first LIMIT requests')
+    parser.add_argument('--url', default=None, help='replay against this server instead of starting one')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--solr-port', type=int, default=8983)
+    parser.add_argument('--loop', default='asyncio', choices=['asyncio', 'uvloop'], help='event loop of the server')
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    fake_solr.add_arguments(parser)
+    args = parser.parse_args()
+
+    requests = load(args.logs, args.methods, args.limit)
+    if not requests:
+        parser.error('the logs contain no requests')
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.url is not None:
+        result = asyncio.run(replay(args.url, None, requests, args.speed, args.timeout))
+    else:
+        solr_args = ['--solr-latency', str(args.solr_latency), '--solr-jitter', str(args.solr_jitter),
+                     '--solr-docs', str(args.solr_docs), '--solr-doc-size', str(args.solr_doc_size)]
+        with Stack(args.port, args.solr_port, solr_args, args.loop) as stack:
+            result = asyncio.run(replay(stack.url, stack.daphne.pid, requests, args.speed, args.timeout))
+        result['loop'] = args.loop
+        result['solr'] = {'latency': args.solr_latency, 'docs': args.solr_docs, 'doc_size': args.solr_doc_size}
+    result['logs'] = args.logs
+    write_report('replay', result, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+hit latency of the shared memory result cache (solr_channel.lib.shmcache) against an in-process dict,
+for growing values, and the hit rate of several processes reading it at once.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from benchmarks.common import write_report, percentiles
+
+
+def hits(lookup, keys, rounds: int) -> dict:
+    samples = []
+    for _ in range(rounds):
+        for key in keys:
+            start = time.perf_counter()
+            lookup(key)
+            samples.append((time.perf_counter() - start) * 1e6)
+    return percentiles(samples)
+
+
+def latency(path: str, sizes, entries: int, rounds: int) -> list:
+    from solr_channel.lib.shmcache import SharedCache
+    results = []
+    for size in sizes:
+        cache = SharedCache(path, max(64 * 1024 * 1024, size * entries * 2), entries * 4, 3600)
+        local = {}
+        keys = [f'select:["bench", {{"query": "q{n}"}}]' for n in range(entries)]
+        for key in keys:
+            value = os.urandom(size)
+            cache.set(key, value)
+            local[key] = value
+        results.append({
+            'size': size,
+            'unit': 'us',
+            'dict': hits(local.get, keys, rounds),
+            'shared': hits(cache.get, keys, rounds),
+        })
+        cache.close()
+        os.remove(cache.path)
+    return results
+
+
+def _reader(path: str, size: int, entries: int, seconds: float, queue):
+    from solr_channel.lib.shmcache import SharedCache
+    cache = SharedCache(path, 64 * 1024 * 1024, entries * 4, 3600)
+    found = missed = 0
+    stop = time.perf_counter() + seconds
+    n = 0
+    while time.perf_counter() < stop:
+        if cache.get(f'key{n % entries}') is None:
+            missed += 1
+        else:
+            found += 1
+        n += 1
+    queue.put((found, missed))
+
+
+def _writer(path: str, size: int, entries: int, seconds: float):
+    from solr_channel.lib.shmcache import SharedCache
+    cache = SharedCache(path, 64 * 1024 * 1024, entries * 4, 3600)
+    stop = time.perf_counter() + seconds
+    n = 0
+    while time.perf_counter() < stop:
+        cache.set(f'key{n % entries}', os.urandom(size))
+        n += 1
+
+
+def concurrent(path: str, processes: int, size: int, entries: int, seconds: float) -> dict:
+    """
+    one process keeps rewriting the entries while the others read them
+    """
+    from solr_channel.lib.shmcache import SharedCache
+    cache = SharedCache(path, 64 * 1024 * 1024, entries * 4, 3600)
+    for n in range(entries):
+        cache.set(f'key{n}', os.urandom(size))
+    queue = multiprocessing.Queue()
+    readers = [multiprocessing.Process(target=_reader, args=(path, size, entries, seconds, queue))
+               for _ in range(processes)]
+    writer = multiprocessing.Process(target=_writer, args=(path, size, entries, seconds))
+    for process in readers + [writer]:
+        process.start()
+    counts = [queue.get() for _ in readers]
+    for process in readers + [writer]:
+        process.join()
+    cache.close()
+    os.remove(cache.path)
+    found = sum(f for f, _ in counts)
+    missed = sum(m for _, m in counts)
+    return {
+        'readers': processes,
+        'size': size,
+        'lookups_per_second': (found + missed) / seconds,
+        'hit_rate': found / max(1, found + missed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 16 * 1024, 256 * 1024], help='value bytes')
+    parser.add_argument('--entries', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=100, help='lookups of every entry')
+    parser.add_argument('--processes', type=int, default=4, help='concurrent readers')
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of the concurrent run')
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), f'bench-shared-cache-{os.getpid()}')
+    write_report('shared_cache', {
+        'latency': latency(path, args.sizes, args.entries, args.rounds),
+        'concurrent': concurrent(path, args.processes, 16 * 1024, args.entries, args.seconds),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
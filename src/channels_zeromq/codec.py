@@ -0,0 +1,139 @@
+"""
+JSON encoding and decoding that does not stall the event loop on large payloads.
+
+the C encoder and decoder hold the GIL until they are done, so handing a multi-megabyte payload to a thread
+alone does not help: the loop waits for the GIL instead of the result. payloads above a threshold are therefore
+processed in a worker thread with variants that give the GIL back regularly:
+
+  - encode: containers near the top are split and their children are encoded one by one with the C encoder,
+    a Solr result becomes one short C call per document
+  - decode: the top containers are parsed by the pure python scanner, everything below them by the C one
+
+small payloads are processed inline, a thread hand-off costs more than encoding them.
+"""
+import asyncio
+import json
+import json.decoder
+import json.scanner
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+
+# 256 KiB, encoding that much on the loop takes a few milliseconds
+DEFAULT_THRESHOLD = 256 * 1024
+# how deep containers are split before the C encoder takes over: envelope, result, response, docs
+SPLIT_DEPTH = 4
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='json')
+
+_decoder = json.JSONDecoder()
+_c_scan_once = (json.scanner.c_make_scanner or json.scanner.py_make_scanner)(_decoder)
+
+
+def _make_scan_once(depth: int):
+    if SPLIT_DEPTH <= depth:
+        return _c_scan_once
+    inner = _make_scan_once(depth + 1)
+
+    def scan_once(string, idx):
+        try:
+            nextchar = string[idx]
+        except IndexError:
+            raise StopIteration(idx) from None
+        if nextchar == '{':
+            return json.decoder.JSONObject((string, idx + 1), _decoder.strict, inner, _decoder.object_hook,
+                                           _decoder.object_pairs_hook, {})
+        if nextchar == '[':
+            return json.decoder.JSONArray((string, idx + 1), inner)
+        return _c_scan_once(string, idx)
+
+    return scan_once
+
+
+_decoder.scan_once = _make_scan_once(0)
+
+
+def estimate_size(obj: Any, limit: int) -> int:
+    """
+    a rough guess of the encoded size, stops counting once it reaches `limit`.
+    lists are estimated by their first element, so this stays cheap for long result lists.
+    """
+    size = 0
+    stack = [(obj, 1)]
+    while stack and size < limit:
+        item, times = stack.pop()
+        if isinstance(item, str):
+            size += (len(item) + 2) * times
+        elif isinstance(item, dict):
+            size += 2 * times
+            for key, value in item.items():
+                size += (len(str(key)) + 4) * times
+                stack.append((value, times))
+                if limit <= size:
+                    break
+        elif isinstance(item, (list, tuple)):
+            size += 2 * times
+            if item:
+                size += 2 * (len(item) - 1) * times
+                stack.append((item[0], times * len(item)))
+        else:
+            size += 8 * times
+    return size
+
+
+def _split(obj: Any, depth: int, parts: List[str]):
+    if depth < SPLIT_DEPTH and isinstance(obj, dict) and obj and all(type(key) is str for key in obj):
+        parts.append('{')
+        for n, (key, value) in enumerate(obj.items()):
+            if n:
+                parts.append(', ')
+            parts.append(json.dumps(key))
+            parts.append(': ')
+            _split(value, depth + 1, parts)
+        parts.append('}')
+    elif depth < SPLIT_DEPTH and isinstance(obj, (list, tuple)) and obj:
+        parts.append('[')
+        for n, value in enumerate(obj):
+            if n:
+                parts.append(', ')
+            _split(value, depth + 1, parts)
+        parts.append(']')
+    else:
+        parts.append(json.dumps(obj))
+
+
+def dumps_chunked(obj: Any) -> str:
+    """
+    the same text as json.dumps, in many short C calls instead of one long one
+    """
+    parts = []
+    _split(obj, 0, parts)
+    return ''.join(parts)
+
+
+def loads_chunked(text: str) -> Any:
+    """
+    json.loads with the pure python scanner for the top containers, it lets other threads run in between
+    """
+    return _decoder.decode(text)
+
+
+class JsonCodec:
+    def __init__(self, threshold: int = DEFAULT_THRESHOLD):
+        """
+        :param threshold: payloads of at least this many characters are processed in a worker thread,
+            None processes everything inline
+        """
+        self.threshold = threshold
+
+    def offload(self, size: int) -> bool:
+        return self.threshold is not None and self.threshold <= size
+
+    async def dumps(self, obj: Any) -> str:
+        if not self.offload(estimate_size(obj, self.threshold or 0)):
+            return json.dumps(obj)
+        return await asyncio.get_event_loop().run_in_executor(_executor, dumps_chunked, obj)
+
+    async def loads(self, text: str) -> Any:
+        if not self.offload(len(text)):
+            return json.loads(text)
+        return await asyncio.get_event_loop().run_in_executor(_executor, loads_chunked, text)
@@ -1,5 +1,4 @@
 import collections
-import json
 import logging
 import random
 import string
@@ -9,45 +8,126 @@
 import zmq
 import zmq.asyncio
 from channels.http import async_to_sync
+from django.conf import settings
 
+from channels_zeromq.codec import JsonCodec, DEFAULT_THRESHOLD
+from channels_zeromq.flow import Overflow
 from channels_zeromq.sane_abc import FlushExtension, SanityCheckedGroupLayer
 from channels_zeromq.sockets import Publisher, Channel
 
 log = logging.getLogger(__name__)
 
+# offload_threshold was not configured, use settings.JSON_OFFLOAD like the consumers do
+FROM_SETTINGS = object()
+
+
+class ChannelRegistry(dict):
+    """
+    like a defaultdict, but the factory gets to know the name of the missing channel
+    """
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, name):
+        chn = self[name] = self.factory(name)
+        return chn
+
 
 class ZeroMqGroupLayer(SanityCheckedGroupLayer, FlushExtension):
 
-    def __init__(self, host='inproc://somename', expiry=60, capacity=1000, channel_capacity=1000, group_expiry=86400, **kwargs):
+    def __init__(self, host='inproc://somename', expiry=60, capacity=1000, channel_capacity=1000, group_expiry=86400,
+                 overflow='drop_newest', overflow_timeout=1.0, channel_overflow=None, publisher_overflow='drop_newest',
+                 offload_threshold=FROM_SETTINGS, **kwargs):
+        """
+        :param overflow: default policy for full channel queues, one of [block, drop_oldest, drop_newest, disconnect]
+        :param overflow_timeout: how long the block policy waits for space, in seconds
+        :param channel_overflow: per channel policies, maps a channel name prefix to a policy
+        :param publisher_overflow: policy for the group_send queue, disconnect is not allowed here
+        :param offload_threshold: messages of at least this many characters are encoded and decoded in a worker
+            thread, see channels_zeromq.codec. None keeps everything on the event loop. by default the THRESHOLD
+            of settings.JSON_OFFLOAD, so the layer and the consumers offload the same payloads.
+        """
         super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, group_expiry=group_expiry,
                          **kwargs)
         self.zmqctx = zmq.asyncio.Context.instance()
         self.host = host
-        self.channels: Dict[str, Channel] = collections.defaultdict(self.make_channel)
-        self.publisher = Publisher(self.host , self.zmqctx, capacity, expiry)
+        self.overflow = Overflow(overflow)
+        self.overflow_timeout = overflow_timeout
+        if offload_threshold is FROM_SETTINGS:
+            offload_threshold = (getattr(settings, 'JSON_OFFLOAD', None) or {}).get('THRESHOLD', DEFAULT_THRESHOLD)
+        self.codec = JsonCodec(offload_threshold)
+        self.channel_overflow = {prefix: Overflow(policy) for prefix, policy in (channel_overflow or {}).items()}
+        self.channels: Dict[str, Channel] = ChannelRegistry(self.make_channel)
+        # messages dropped by channels that were discarded since, so the totals in stats() never go down
+        self.discarded_drops = 0
+        self.publisher = Publisher(self.host, self.zmqctx, capacity, expiry, Overflow(publisher_overflow),
+                                   overflow_timeout)
         reactor.addSystemEventTrigger('before', 'shutdown', self.shutdown)
         for k, v in kwargs.items():
             log.warning(f'unparsed config entry: {k}: {v}')
 
     extensions = ['groups', 'flush']
 
-    def make_channel(self):
-        chn = Channel(self.host, self.zmqctx, self.capacity)
+    def make_channel(self, name):
+        chn = Channel(self.host, self.zmqctx, self.capacity, self.overflow_policy(name), self.overflow_timeout, name,
+                      self.codec)
         return chn
 
+    def overflow_policy(self, channel: str) -> Overflow:
+        # the longest matching prefix wins
+        for prefix in sorted(self.channel_overflow, key=len, reverse=True):
+            if channel.startswith(prefix):
+                return self.channel_overflow[prefix]
+        return self.overflow
+
+    def backpressure(self, channel: str) -> asyncio.Event:
+        """
+        the event is set while the channel's queue is full, use it to slow down producers
+        """
+        return self.channels[channel].queue.congested
+
+    def dropped(self) -> Dict[str, Dict[str, int]]:
+        """
+        dropped messages per channel and group, direct sends are accounted to the empty group name.
+        """
+        stats = {name: dict(chn.dropped) for name, chn in self.channels.items() if chn.dropped}
+        if self.publisher.dropped:
+            stats['publisher'] = dict(self.publisher.dropped)
+        return stats
+
     def shutdown(self):
         log.error('shutdown hook tripped')
         loop=asyncio.get_event_loop()
         loop.run_until_complete(self.close())
         log.error('shutdown hook done')
 
+    def stats(self) -> dict:
+        """
+        may be called from another thread, i.e. the metrics view, so it works on a copy of the channels
+        """
+        # read before the copy, a channel discarded in between is missed once instead of counted twice
+        discarded_drops = self.discarded_drops
+        channels = list(self.channels.values())
+        depths = [chn.queue.qsize() for chn in channels]
+        return {
+            'channels': len(channels),
+            'channel_queue_depth': sum(depths),
+            'channel_queue_depth_max': max(depths, default=0),
+            'congested_channels': sum(1 for chn in channels if chn.queue.congested.is_set()),
+            'publisher_queue_depth': self.publisher.queue.qsize(),
+            'dropped_channel_messages': discarded_drops + sum(sum(chn.dropped.values()) for chn in channels),
+            'dropped_publisher_messages': sum(self.publisher.dropped.values()),
+        }
+
     async def on_receive(self, channel: str):
         message = await self.channels[channel].receive()
         log.debug(f'message: {message}')
         return message
 
     async def on_send(self, channel: str, message: dict):
-        await self.channels[channel].send(json.dumps(message))
+        await self.channels[channel].send(await self.codec.dumps(message))
 
     async def on_new_channel(self, prefix="specific."):
         rand = ''.join(random.choice(string.ascii_letters) for _ in range(12))
@@ -65,9 +145,22 @@ async def on_group_discard(self, group, channel):
         log.debug(f'group: [{group}] channel: [{channel}]')
         self.channels[channel].unsubscribe(group)
 
+    async def discard_channel(self, channel: str):
+        """
+        forget a channel and everything still queued for it, i.e. after its consumer disconnected
+        """
+        chn = self.channels.pop(channel, None)
+        if chn is None:
+            return
+        pending = chn.queue.qsize()
+        if pending:
+            log.info(f'channel: [{channel}] discarding {pending} undelivered messages')
+        self.discarded_drops += sum(chn.dropped.values())
+        chn.close()
+
     async def on_group_send(self, group, message):
         log.info(f'group: [{group}] message: [{message}]')
-        await self.publisher.send_group(group, json.dumps(message))
+        await self.publisher.send_group(group, await self.codec.dumps(message))
 
     async def flush(self):
         raise NotImplementedError
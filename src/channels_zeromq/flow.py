@@ -0,0 +1,120 @@
+import asyncio
+import collections
+import logging
+from enum import Enum
+
+log = logging.getLogger(__name__)
+
+
+class Overflow(Enum):
+    """
+    what to do with a message that arrives at a full queue
+    """
+    BLOCK = 'block'  # wait up to `timeout` seconds for space, then drop the message
+    DROP_OLDEST = 'drop_oldest'  # make room by dropping the oldest queued message
+    DROP_NEWEST = 'drop_newest'  # drop the message that just arrived
+    DISCONNECT = 'disconnect'  # the consumer is too slow, tell it to go away
+
+
+# sent to a consumer instead of its backlog when it is disconnected for being too slow, its consumer has to close
+# the websocket in `flow_slow_consumer`. a websocket.disconnect would only stop the consumer and leave the socket open.
+# 1013: try again later
+SLOW_CONSUMER_TYPE = 'flow.slow_consumer'
+SLOW_CONSUMER_MESSAGE = '{"type": "%s", "code": 1013}' % SLOW_CONSUMER_TYPE
+
+
+class FlowQueue(asyncio.Queue):
+    """
+    asyncio.Queue with an overflow policy, drop counters and a backpressure signal.
+
+    `congested` is set as soon as the queue is full and cleared once it drained to half its capacity,
+    `wait_drained` can be used to hold off producers until then.
+
+    every message is queued together with the group or channel it is accounted to, so a message that is dropped
+    after it was queued is counted for its own key. `get` returns the message alone.
+    """
+
+    def __init__(self, capacity, policy: Overflow = Overflow.DROP_NEWEST, timeout: float = 1.0, name=''):
+        super().__init__(capacity)
+        self.policy = Overflow(policy)
+        self.timeout = timeout
+        self.name = name
+        self.dropped = collections.Counter()
+        self.disconnected = False
+        self.congested = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    async def offer(self, item, key='') -> bool:
+        """
+        put `item` into the queue according to the overflow policy.
+        :param item: the message
+        :param key: the group or channel the message is accounted to, if it gets dropped
+        :return: whether the item was queued
+        """
+        if self.disconnected:
+            self._drop(key)
+            return False
+        try:
+            self.put_nowait((key, item))
+            return True
+        except asyncio.QueueFull:
+            self._congest()
+
+        if Overflow.BLOCK == self.policy:
+            try:
+                await asyncio.wait_for(self.put((key, item)), timeout=self.timeout)
+                return True
+            except asyncio.TimeoutError:
+                self._drop(key)
+                return False
+        if Overflow.DROP_OLDEST == self.policy:
+            oldest_key = self._queue[0][0]
+            self.get_nowait()
+            self.task_done()
+            self._drop(oldest_key)
+            self.put_nowait((key, item))
+            return True
+        if Overflow.DISCONNECT == self.policy:
+            self.disconnect()
+            self._drop(key)
+            return False
+        self._drop(key)
+        return False
+
+    def disconnect(self):
+        """
+        throw away the backlog and leave only the disconnect message for the consumer
+        """
+        log.warning(f'{self.name}: disconnecting slow consumer')
+        self.disconnected = True
+        while not self.empty():
+            self.dropped[self._queue[0][0]] += 1
+            self.get_nowait()
+            self.task_done()
+        self.put_nowait(('', SLOW_CONSUMER_MESSAGE))
+
+    def _get(self):
+        # asyncio.Queue's hook for get and get_nowait, the key stays behind
+        return self._queue.popleft()[1]
+
+    def get_nowait(self):
+        item = super().get_nowait()
+        if self.congested.is_set() and self.qsize() <= self.maxsize // 2:
+            log.info(f'{self.name}: drained, {sum(self.dropped.values())} messages dropped so far')
+            self.congested.clear()
+            self._drained.set()
+        return item
+
+    async def wait_drained(self):
+        await self._drained.wait()
+
+    def _congest(self):
+        if not self.congested.is_set():
+            log.warning(f'{self.name}: queue full ({self.maxsize}), applying {self.policy.value}')
+            self.congested.set()
+            self._drained.clear()
+
+    def _drop(self, key):
+        self.dropped[key] += 1
+        log.debug(f'{self.name}: dropped message for [{key}]')
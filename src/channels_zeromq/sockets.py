@@ -1,28 +1,32 @@
 import asyncio
-import json
 import logging
 
 import zmq
 import zmq.asyncio
 
+from channels_zeromq.codec import JsonCodec
+from channels_zeromq.flow import FlowQueue, Overflow
+
 log = logging.getLogger(__name__)
 
 
 class Channel:
-    def __init__(self, host, context: zmq.asyncio.Context, capacity):
+    def __init__(self, host, context: zmq.asyncio.Context, capacity, policy=Overflow.DROP_NEWEST, timeout=1.0,
+                 name='', codec: JsonCodec = None):
+        self.codec = codec or JsonCodec()
         self.socket = context.socket(zmq.SUB)
         self.socket.connect(host)
         # high water mark, aka: when to block or drop packets
         self.socket.hwm = capacity
-        self.queue = asyncio.Queue(capacity)
+        self.queue = FlowQueue(capacity, policy, timeout, name)
         self.task = asyncio.create_task(self._group_receive())
         log.debug(f'finished: {__name__}')
 
     async def receive(self):
         payload = await self.queue.get()
-        decoded_payload = json.loads(payload)
-        log.debug(f'decoded_payload:{decoded_payload}')
         self.queue.task_done()
+        decoded_payload = await self.codec.loads(payload)
+        log.debug(f'decoded_payload:{decoded_payload}')
         return decoded_payload
 
     async def _group_receive(self):
@@ -34,16 +38,18 @@ async def _group_receive(self):
 
             group_name, payload = msg.split('|', maxsplit=1)
             log.debug(f'group_name: {group_name}, payload:{payload}')
-            try:
-                self.queue.put_nowait(payload)
-            except asyncio.QueueFull as e:
-                log.exception(e)
+            await self.queue.offer(payload, group_name)
+
+    async def send(self, message: str) -> bool:
+        return await self.queue.offer(message)
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
 
-    async def send(self, message: str):
-        try:
-            self.queue.put_nowait(message)
-        except asyncio.QueueFull as e:
-            log.exception(e)
+    @property
+    def disconnected(self):
+        return self.queue.disconnected
 
     def subscribe(self, group_name):
         self.socket.subscribe(group_name)
@@ -56,52 +62,54 @@ def unsubscribe(self, group_name):
     def close(self):
         log.info('stopping worker')
         self.task.cancel()
-        log.info('joining queue')
-        self.queue.join()
         log.info('closing socket')
-        self.socket.close()
+        self.socket.close(linger=0)
         log.debug('closed')
 
 
 class Publisher:
-    TASK_COUNT = 4
-
-    def __init__(self, host, context, capacity, expiry):
+    def __init__(self, host, context, capacity, expiry, policy=Overflow.DROP_NEWEST, timeout=1.0):
+        if Overflow.DISCONNECT == Overflow(policy):
+            raise ValueError('the publisher has no consumer to disconnect, use a drop policy instead')
         self.socket = context.socket(zmq.PUB)
         self.socket.hwm = capacity
         self.expiry = expiry
         self.socket.bind(host)
-        self.queue = asyncio.Queue(capacity)
-        self.tasks = [asyncio.create_task(self._send_group()) for _ in range(self.TASK_COUNT)]
+        self.queue = FlowQueue(capacity, policy, timeout, 'publisher')
+        self.task = asyncio.create_task(self._send_group())
 
     async def _send_group(self):
         while True:
-            group, message = await self.queue.get()
-            try:
-                await asyncio.wait_for(
-                    self.socket.send_string(f'{group}|{message}', flags=zmq.NOBLOCK),
-                    timeout=self.expiry)
-            except zmq.error.ZMQError as e:
-                """
-                Sending to a group never raises ChannelFull; 
-                instead, it must silently drop the message if it is over capacity, 
-                as per ASGI’s at-most-once delivery policy.
-                """
-                log.exception(e)
-            self.queue.task_done()
-            if group == 'STOP' and message == 'STOP':
+            # sleep until there is something to send, then send everything that piled up in the meantime
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            for group, message in batch:
+                try:
+                    # a PUB socket never blocks, with NOBLOCK the send is done when the call returns
+                    await self.socket.send_string(f'{group}|{message}', flags=zmq.NOBLOCK)
+                except zmq.error.ZMQError as e:
+                    """
+                    Sending to a group never raises ChannelFull; 
+                    instead, it must silently drop the message if it is over capacity, 
+                    as per ASGI’s at-most-once delivery policy.
+                    """
+                    self.queue.dropped[group] += 1
+                    log.debug(f'dropped message for [{group}]: {e}')
+                self.queue.task_done()
+            if ('STOP', 'STOP') in batch:
                 break
 
-    async def send_group(self, group: str, message: str):
-        try:
-            self.queue.put_nowait((group, message))
-        except asyncio.QueueFull as e:
-            log.exception(e)
+    async def send_group(self, group: str, message: str) -> bool:
+        return await self.queue.offer((group, message), group)
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
 
     def close(self):
-        log.info(f'stopping workers')
-        for task in self.tasks:
-            task.cancel()
+        log.info(f'stopping worker')
+        self.task.cancel()
         log.info('join queue')
         self.queue.join()
         log.info('closing socket')
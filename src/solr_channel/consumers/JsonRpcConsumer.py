@@ -1,40 +1,117 @@
 from abc import abstractmethod
 import json
 import logging
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
-from dataclasses import dataclass, field, asdict
+from dataclasses import asdict, is_dataclass
 from typing import Union, Any
 from .JsonRpcExceptions import *
+from solr_channel.lib import metrics, tracing
+from solr_channel.lib.jsoncodec import json_codec
+from solr_channel.lib.recorder import recorder
 
 log = logging.getLogger(__name__)
 
+# clients that were turned away, nothing went wrong. they are counted in sonne_rpc_requests_total{outcome="limited"}
+# and the like, logging every one of them would flood the log exactly when a client misbehaves.
+REJECTIONS = (JsonRpcRateLimited, JsonRpcOverloaded)
 
-@dataclass
-class JsonRpcRequest:
-    jsonrpc: str
-    method: str
-    id: Union[str, int]
-    params: dict = field(default_factory=dict)
 
-    def __post_init__(self):
-        if '2.0' != self.jsonrpc:
-            raise JsonRpcInvalidRequest(f'only jsonrpc 2.0 is supported, you sent {self.jsonrpc}')
-        if type(id) is str and self.method.startswith('rpc.'):
+class Envelope:
+    """
+    the base of the JSON-RPC messages. they are slotted and encode themselves, the payload is encoded as it is
+    instead of being copied into a dict first.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, name) == getattr(other, name)
+                                                 for name in self.__slots__)
+
+    def __repr__(self):
+        members = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({members})'
+
+
+class JsonRpcRequest(Envelope):
+    __slots__ = ('jsonrpc', 'method', 'id', 'params')
+
+    def __init__(self, jsonrpc: str, method: str, id: Union[str, int], params: dict = None):
+        if '2.0' != jsonrpc:
+            raise JsonRpcInvalidRequest(f'only jsonrpc 2.0 is supported, you sent {jsonrpc}')
+        if type(id) is str and method.startswith('rpc.'):
             raise JsonRpcInvalidRequest(f'you may not call internal RPC methods (methods starting with "rpc.")')
+        self.jsonrpc = jsonrpc
+        self.method = method
+        self.id = id
+        self.params = {} if params is None else params
+
+
+class RawJson:
+    """
+    a result that is already encoded, i.e. the body of a solr response. it is spliced into the response as is.
+    """
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __eq__(self, other):
+        return isinstance(other, RawJson) and self.text == other.text
+
+    def __repr__(self):
+        return f'RawJson({len(self.text)} characters)'
+
+
+async def encode_payload(payload: Any) -> str:
+    """
+    large payloads are encoded off the event loop, see channels_zeromq.codec
+    """
+    if isinstance(payload, RawJson):
+        return payload.text
+    if is_dataclass(payload) and not isinstance(payload, type):
+        payload = asdict(payload)
+    return await json_codec().dumps(payload)
+
+
+class JsonRpcErrorResponse(Envelope):
+    __slots__ = ('error', 'id', 'jsonrpc')
+
+    def __init__(self, error: dict, id: Union[str, int, None], jsonrpc: str = '2.0'):
+        self.error = error
+        self.id = id
+        self.jsonrpc = jsonrpc
+
+    async def encode(self) -> str:
+        # errors are small
+        error = json.dumps(self.error)
+        return f'{{"error": {error}, "id": {json.dumps(self.id)}, "jsonrpc": {json.dumps(self.jsonrpc)}}}'
 
 
-@dataclass
-class JsonRpcErrorResponse:
-    error: dict
-    id: Union[str, int]  # can be none, tho.
-    jsonrpc: str = '2.0'
+class JsonRpcResultResponse(Envelope):
+    __slots__ = ('result', 'id', 'jsonrpc')
 
+    def __init__(self, result: Any, id: Union[str, int], jsonrpc: str = '2.0'):
+        self.result = result
+        self.id = id
+        self.jsonrpc = jsonrpc
 
-@dataclass
-class JsonRpcResultResponse:
-    result: dict
-    id: Union[str, int]
-    jsonrpc: str = '2.0'
+    async def encode(self) -> str:
+        result = await encode_payload(self.result)
+        return f'{{"result": {result}, "id": {json.dumps(self.id)}, "jsonrpc": {json.dumps(self.jsonrpc)}}}'
+
+
+class JsonRpcNotification(Envelope):
+    __slots__ = ('method', 'params', 'jsonrpc')
+
+    def __init__(self, method: str, params: dict, jsonrpc: str = '2.0'):
+        self.method = method
+        self.params = params
+        self.jsonrpc = jsonrpc
+
+    async def encode(self) -> str:
+        params = await encode_payload(self.params)
+        return f'{{"method": {json.dumps(self.method)}, "params": {params}, "jsonrpc": {json.dumps(self.jsonrpc)}}}'
 
 
 async def build_request(text_data):
@@ -59,36 +136,89 @@ class JsonRpcConsumer(AsyncWebsocketConsumer):
     Variant of AsyncWebsocketConsumer that automatically JSON-encodes and decodes
     messages as they come in and go out. Expects everything to be text; will
     error on binary data.
+
+    Once a client negotiated a compression, responses above its threshold are sent as compressed binary frames.
     """
+    compression = None
+    # the id this connection's requests are recorded under, empty if it is not recorded, None until it is decided
+    recording = None
 
     async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        start = time.time()
         try:
             request = await build_request(text_data)
         except JsonRpcException as e:
             await self.send_error(e, None)
             return
+        self.record(request, start)
 
+        tracer = tracing.get_tracer()
+        trace = tracer.start(request.id, request.method)
+        if trace is not None:
+            trace.add('decode', start, size=len(text_data))
+        token = tracing.activate(trace)
         try:
             await self.handle_request(request)
         except JsonRpcException as e:
-            log.exception(e)
+            if not isinstance(e, REJECTIONS):
+                log.exception(e)
             await self.send_error(e, request.id)
             return
         except Exception as e:
             log.exception(e)
             await self.send_error(JsonRpcInternalError(f'something bad happened, sorry.'), request.id)
+        finally:
+            tracing.deactivate(token)
+            tracer.finish(trace)
+
+    async def flow_slow_consumer(self, message: dict):
+        """
+        the channel layer gave up on this consumer because it fell too far behind, see channels_zeromq.flow
+        """
+        log.warning(f'closing {self.channel_name}, it could not keep up with its messages')
+        await self.close(code=message.get('code', 1013))
+
+    def record(self, request: JsonRpcRequest, received: float):
+        """
+        write the request to the recorder's log if this connection is sampled, see solr_channel.lib.recorder
+        """
+        rec = recorder()
+        if rec is None:
+            return
+        if self.recording is None:
+            self.recording = rec.connection()
+        if self.recording:
+            rec.record(self.recording, request.id, request.method, request.params, received)
 
     async def send_error(self, exception: JsonRpcException, msg_id):
-        log.error(exception.message)
-        await self.send_json(asdict(JsonRpcErrorResponse(exception.error, msg_id)))
+        if isinstance(exception, REJECTIONS):
+            log.debug(exception.message)
+        else:
+            log.error(exception.message)
+        await self.send_envelope(JsonRpcErrorResponse(exception.error, msg_id))
 
     async def send_response(self, response: JsonRpcResultResponse):
-        logging.debug(response)
-        await self.send_json(asdict(response))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(response)
+        if self.recording and isinstance(response.result, dict):
+            # the ids a replay has to map, see solr_channel.lib.recorder
+            recorder().record_result(self.recording, response.id, response.result)
+        await self.send_envelope(response)
 
     async def send_result(self, result: Any, rqid: str):
         await self.send_response(JsonRpcResultResponse(result, rqid))
 
+    async def send_notification(self, method: str, params: dict):
+        """
+        a message the client did not ask for, it has no id
+        """
+        await self.send_envelope(JsonRpcNotification(method, params))
+
+    async def send_envelope(self, envelope: Union[JsonRpcErrorResponse, JsonRpcResultResponse, JsonRpcNotification]):
+        with tracing.span('encode'):
+            text_data = await envelope.encode()
+        await self.send_text(text_data)
+
     @abstractmethod
     async def handle_request(self, request: JsonRpcRequest):
         """
@@ -102,15 +232,39 @@ async def send_json(self, content, close=False):
         """
         Encode the given content as JSON and send it to the client.
         """
-        await super().send(
-            text_data=await self.encode_json(content),
-            close=close,
-        )
+        with tracing.span('encode'):
+            text_data = await self.encode_json(content)
+        await self.send_text(text_data, close)
+
+    async def send_text(self, text_data: str, close=False):
+        """
+        send encoded JSON, compressed if the client asked for it
+        """
+        # the threshold is in bytes, non-ASCII text is longer on the wire than it has characters
+        encoded = text_data.encode() if self.compression is not None else None
+        if encoded is not None and self.compression.threshold < len(encoded):
+            with tracing.span('compress'):
+                bytes_data = await self.compression.compress(encoded)
+            metrics.rpc_response_bytes.inc(len(encoded), encoding='identity')
+            metrics.rpc_wire_bytes.inc(len(bytes_data), encoding=self.compression.algorithm)
+            with tracing.span('send', size=len(bytes_data)):
+                await super().send(
+                    bytes_data=bytes_data,
+                    close=close,
+                )
+            return
+        metrics.rpc_response_bytes.inc(len(text_data), encoding='identity')
+        metrics.rpc_wire_bytes.inc(len(text_data), encoding='identity')
+        with tracing.span('send', size=len(text_data)):
+            await super().send(
+                text_data=text_data,
+                close=close,
+            )
 
     @classmethod
     async def decode_json(cls, text_data):
-        return json.loads(text_data)
+        return await json_codec().loads(text_data)
 
     @classmethod
     async def encode_json(cls, content):
-        return json.dumps(content)
+        return await json_codec().dumps(content)
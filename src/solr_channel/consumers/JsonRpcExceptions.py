@@ -41,3 +41,18 @@ def __init__(self, message, data=None):
 class JsonRpcServerError(JsonRpcException):
     def __init__(self, message, data=None):
         super().__init__(-32000, message, data)
+
+
+class JsonRpcRateLimited(JsonRpcException):
+    def __init__(self, message, data=None):
+        super().__init__(-32001, message, data)
+
+
+class JsonRpcOverloaded(JsonRpcException):
+    def __init__(self, message, data=None):
+        super().__init__(-32002, message, data)
+
+
+class JsonRpcDeadlineExceeded(JsonRpcException):
+    def __init__(self, message, data=None):
+        super().__init__(-32003, message, data)
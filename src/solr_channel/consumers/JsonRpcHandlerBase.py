@@ -1,31 +1,64 @@
+import asyncio
 import dataclasses
 import inspect
 import logging
+import time
 from enum import Enum
-from typing import Dict, Iterable
+from typing import Dict, Iterable, Optional, Set
+from solr_channel.lib import admission, metrics, tracing
+from solr_channel.lib.compression import Compression, algorithms
 from solr_channel.lib.schema import make_json_schema, make_json_schema_dc, get_parameters
-from functools import wraps
+from functools import wraps, partial
 
 from django.conf import settings
 
-from .JsonRpcConsumer import JsonRpcConsumer, JsonRpcRequest, JsonRpcResultResponse
+from .JsonRpcConsumer import JsonRpcConsumer, JsonRpcRequest, JsonRpcResultResponse, REJECTIONS
 from .JsonRpcExceptions import *
 
-__all__ = ['JsonRpcHandlerBase', 'command', 'chn_command', 'Availability']
+__all__ = ['JsonRpcHandlerBase', 'command', 'chn_command', 'Availability', 'Cost']
 log = logging.getLogger(__name__)
 
+# clients may send a deadline in seconds with the params of any command
+DEADLINE_PARAM = 'deadline'
+# the absolute deadline travels under this key in channel layer messages
+DEADLINE_KEY = '_deadline'
+
 
 class Availability(Enum):
     DEBUG_ONLY = 'DEBUG_ONLY'
     PRODUCTION = 'PRODUCTION'
 
 
+class Cost(Enum):
+    """
+    the cost class of a command, every class has its own rate limit per connection
+    """
+    CHEAP = 'cheap'
+    NORMAL = 'normal'
+    EXPENSIVE = 'expensive'
+
+
 class JsonRpcHandlerBase(JsonRpcConsumer):
     commands = {}
     chn_commands = {}
+    costs = {}
+    deadlines = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = admission.make_buckets()
+        self.admitted = False
+        self.inflight: Set[asyncio.Future] = set()
+
+    @classmethod
+    def _register_limits(cls, decorated_fn, cost: Cost, deadline: Optional[float]):
+        _cls, func_name = decorated_fn.__qualname__.split('.')
+        cls.costs.setdefault(_cls, {})[func_name] = cost
+        cls.deadlines.setdefault(_cls, {})[func_name] = deadline
 
     @classmethod
-    def command(cls, availability: Availability, argdoc: Dict[str, str] = None, returns=None):
+    def command(cls, availability: Availability, argdoc: Dict[str, str] = None, returns=None, cost=Cost.NORMAL,
+                deadline: float = None):
         def register_func(decorated_fn):
             if not settings.DEBUG and availability == Availability.DEBUG_ONLY:
                 log.error(f'ignoring debug only function: {decorated_fn.__qualname__}')
@@ -37,19 +70,25 @@ def register_func(decorated_fn):
             _cls, func_name = decorated_fn.__qualname__.split('.')
             if _cls not in cls.commands:
                 cls.commands[_cls] = {}
-            schema = make_json_schema(decorated_fn, argdoc)
-            cls.commands[_cls][func_name] = schema
-            log.info(schema)
+            # the schema is only needed for help, build it on first use instead of at import
+            cls.commands[_cls][func_name] = partial(make_json_schema, decorated_fn, argdoc)
+            cls._register_limits(decorated_fn, cost, deadline)
             return decorated_fn
 
         return register_func
 
     @classmethod
-    def chn_command(cls, availability: Availability, argdoc: Dict[str, str] = None):
+    def chn_command(cls, availability: Availability, argdoc: Dict[str, str] = None, cost=Cost.NORMAL,
+                    deadline: float = None):
         def register_func(decorated_fn):
-            @wraps(decorated_fn)
-            async def type_wrapper(self: JsonRpcHandlerBase, event: dict):
+            async def run_command(self: JsonRpcHandlerBase, event: dict):
                 rqid = event.get('rqid', None)
+                method = decorated_fn.__name__
+                start = time.perf_counter()
+                header = event.pop(tracing.MESSAGE_KEY, None)
+                trace = tracing.Trace.from_header(header) if header else None
+                token = tracing.activate(trace)
+                deadline_at = event.pop(DEADLINE_KEY, None)
                 _, p = get_parameters(inspect.signature(decorated_fn))
                 dcls = p.annotation
                 try:
@@ -57,14 +96,32 @@ async def type_wrapper(self: JsonRpcHandlerBase, event: dict):
                 except TypeError as e:
                     log.exception(e)
                     log.error(str(event))
+                    metrics.rpc_requests.inc(method=method, outcome='invalid')
                     await self.handle_exception(JsonRpcInvalidParams(str(e)), rqid)
+                    tracing.deactivate(token)
+                    tracing.get_tracer().finish(trace)
                     return
                 try:
-                    result = await decorated_fn(self, dc)
+                    with tracing.span('command'), admission.solr_class(self.cost_of(method).value):
+                        result = await self.within_deadline(decorated_fn(self, dc), deadline_at)
                     await self.send_result(result, rqid)
+                    metrics.rpc_requests.inc(method=method, outcome='ok')
                     return
+                except asyncio.CancelledError:
+                    metrics.rpc_requests.inc(method=method, outcome='cancelled')
+                    raise
                 except Exception as e:
+                    metrics.rpc_requests.inc(method=method, outcome='error')
                     return await self.handle_exception(e, rqid)
+                finally:
+                    metrics.rpc_latency.observe(time.perf_counter() - start, method=method)
+                    tracing.deactivate(token)
+                    tracing.get_tracer().finish(trace)
+
+            @wraps(decorated_fn)
+            async def type_wrapper(self: JsonRpcHandlerBase, event: dict):
+                # run the command next to the consumer, so the consumer can take the next message or the disconnect
+                self.spawn(run_command(self, event))
 
             if availability == Availability.DEBUG_ONLY and not settings.DEBUG:
                 log.warning(f'ignoring debug only function: {decorated_fn.__qualname__}')
@@ -76,9 +133,8 @@ async def type_wrapper(self: JsonRpcHandlerBase, event: dict):
             _cls_name, func_name = decorated_fn.__qualname__.split('.')
             if _cls_name not in cls.chn_commands:
                 cls.chn_commands[_cls_name] = {}
-            schema = make_json_schema_dc(decorated_fn, argdoc)
-            cls.chn_commands[_cls_name][func_name] = schema
-            log.info(schema)
+            cls.chn_commands[_cls_name][func_name] = partial(make_json_schema_dc, decorated_fn, argdoc)
+            cls._register_limits(decorated_fn, cost, deadline)
             return type_wrapper
 
         return register_func
@@ -93,8 +149,98 @@ def _chn_commands(self) -> dict:
         name = self.__class__.__name__
         return self.chn_commands.get(name, {})
 
+    @staticmethod
+    def describe(registry: dict) -> dict:
+        """
+        the schemas of a command registry, built on first use
+        """
+        for name, schema in registry.items():
+            if callable(schema):
+                registry[name] = schema()
+        return registry
+
+    async def admit(self) -> bool:
+        """
+        call this first thing in connect(), turns the connection away if the process is saturated
+        """
+        shed, reason = admission.should_shed_connection()
+        if shed:
+            log.warning(f'shedding connection: {reason}')
+            metrics.rpc_shed_connections.inc()
+            await self.close(code=1013)
+            return False
+        self.admitted = True
+        admission.connection_opened()
+        return True
+
+    async def disconnect(self, code):
+        if self.admitted:
+            self.admitted = False
+            admission.connection_closed()
+        if self.inflight:
+            log.info(f'cancelling {len(self.inflight)} running commands')
+        for task in list(self.inflight):
+            task.cancel()
+        # messages that are still queued for this consumer will never be read
+        if hasattr(self.channel_layer, 'discard_channel'):
+            await self.channel_layer.discard_channel(self.channel_name)
+        return await super().disconnect(code)
+
+    def spawn(self, coroutine) -> asyncio.Future:
+        """
+        run a coroutine for this connection, it is cancelled when the client disconnects
+        """
+        task = asyncio.ensure_future(coroutine)
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+        return task
+
+    def deadline_for(self, method: str, requested) -> Optional[float]:
+        """
+        :param requested: the deadline the client sent, in seconds. it can only shorten the default of the method.
+        :return: the absolute deadline, as time.time()
+        """
+        default = self.deadlines.get(self.__class__.__name__, {}).get(method, None)
+        if requested is not None:
+            if not isinstance(requested, (int, float)) or isinstance(requested, bool) or 0 >= requested:
+                raise JsonRpcInvalidParams(f'{DEADLINE_PARAM} must be a positive number of seconds')
+            default = requested if default is None else min(requested, default)
+        if default is None:
+            return None
+        return time.time() + default
+
+    @staticmethod
+    async def within_deadline(awaitable, deadline_at: Optional[float]):
+        if deadline_at is None:
+            return await awaitable
+        remaining = deadline_at - time.time()
+        if 0 >= remaining:
+            awaitable.close()
+            raise JsonRpcDeadlineExceeded('deadline exceeded before the command started')
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError:
+            if time.time() < deadline_at:
+                # a timeout of the command itself, not ours
+                raise
+            raise JsonRpcDeadlineExceeded(f'deadline exceeded, the command was cancelled')
+
+    def cost_of(self, method: str) -> Cost:
+        return self.costs.get(self.__class__.__name__, {}).get(method, Cost.NORMAL)
+
+    def check_rate_limit(self, method: str):
+        cost = self.cost_of(method)
+        bucket = self.buckets.get(cost.value)
+        if bucket is not None and not bucket.try_acquire():
+            metrics.rpc_requests.inc(method=method, outcome='limited')
+            raise JsonRpcRateLimited(f'too many {cost.value} requests, slow down',
+                                     {'retry_after': round(bucket.retry_after(), 3)})
+
     async def handle_exception(self, e, msg_id: str):
-        log.exception(e)
+        if isinstance(e, admission.Overloaded):
+            e = JsonRpcOverloaded(f'server overloaded, try again later: {e}')
+        if not isinstance(e, REJECTIONS):
+            log.exception(e)
         if issubclass(type(e),JsonRpcException):
             await self.send_error(e,msg_id)
         else:
@@ -105,15 +251,44 @@ async def respond(self, request, awaitable):
         async for result in awaitable:
             await self.send_response(JsonRpcResultResponse(result, request.id))
 
+    async def negotiate_compression(self, params: dict) -> dict:
+        """
+        the client picks an algorithm and a threshold in bytes, or null to turn compression off.
+        """
+        algorithm = params.get('algorithm', None)
+        if algorithm is None:
+            self.compression = None
+            return {'algorithm': None, 'available': sorted(algorithms())}
+        if not isinstance(algorithm, str):
+            raise JsonRpcInvalidParams(f'algorithm must be one of {sorted(algorithms())} or null')
+        threshold = params.get('threshold', settings.COMPRESSION['THRESHOLD'])
+        # bool is a subclass of int, but true is not a number of bytes
+        if not isinstance(threshold, int) or isinstance(threshold, bool) or 0 > threshold:
+            raise JsonRpcInvalidParams('threshold must be a number of bytes')
+        try:
+            self.compression = Compression(algorithm, threshold, settings.COMPRESSION['LEVELS'].get(algorithm))
+        except ValueError as e:
+            raise JsonRpcInvalidParams(str(e))
+        return {**self.compression.describe(), 'available': sorted(algorithms())}
+
     async def handle_request(self, request: JsonRpcRequest):
         if 'help' == request.method:
-            await self.send_response(JsonRpcResultResponse(self._commands, request.id))
+            await self.send_response(JsonRpcResultResponse(self.describe(self._commands), request.id))
+            return
+        if 'set_compression' == request.method:
+            if not isinstance(request.params, dict):
+                raise JsonRpcInvalidParams(f'params must be an object')
+            # binary frames are always compressed and text frames never are, so the switch needs no coordination
+            result = await self.negotiate_compression(request.params)
+            await self.send_response(JsonRpcResultResponse(result, request.id))
             return
 
         if request.method not in self._commands and request.method not in self._chn_commands:
             raise JsonRpcMethodNotFound(f'no such method: {request.method}. use "help" to request available methods')
         if not isinstance(request.params, dict):
             raise JsonRpcInvalidParams(f'params must be an object')
+        # invalid requests are rejected before they take a token, see check_rate_limit below
+        deadline_at = self.deadline_for(request.method, request.params.pop(DEADLINE_PARAM, None))
 
         if request.method in self._commands:
             async_fun = getattr(self, request.method)
@@ -122,16 +297,39 @@ async def handle_request(self, request: JsonRpcRequest):
             try:
                 awaitable = async_fun(**params)
             except TypeError as e:
+                metrics.rpc_requests.inc(method=request.method, outcome='invalid')
                 raise JsonRpcInvalidParams(str(e))
-            await awaitable
+            try:
+                self.check_rate_limit(request.method)
+            except JsonRpcRateLimited:
+                awaitable.close()
+                raise
+            try:
+                with metrics.rpc_latency.time(method=request.method), \
+                        admission.solr_class(self.cost_of(request.method).value):
+                    await self.within_deadline(awaitable, deadline_at)
+            except admission.Overloaded as e:
+                metrics.rpc_requests.inc(method=request.method, outcome='error')
+                raise JsonRpcOverloaded(f'server overloaded, try again later: {e}')
+            except Exception:
+                metrics.rpc_requests.inc(method=request.method, outcome='error')
+                raise
+            metrics.rpc_requests.inc(method=request.method, outcome='ok')
             return
 
         if request.method in self._chn_commands:
-            await self.channel_layer.send(self.channel_name, {
+            message = {
                 'type': request.method,
                 'rqid': request.id,
                 **request.params
-            })
+            }
+            trace = tracing.current()
+            if trace is not None:
+                message[tracing.MESSAGE_KEY] = trace.header()
+            if deadline_at is not None:
+                message[DEADLINE_KEY] = deadline_at
+            self.check_rate_limit(request.method)
+            await self.channel_layer.send(self.channel_name, message)
 
 
 command = JsonRpcHandlerBase.command
@@ -1,25 +1,35 @@
 import logging
 import random
 import string
+import time
 from dataclasses import dataclass
 from enum import Enum
 from json.decoder import JSONDecodeError
-from typing import List
+from typing import List, Tuple
 
-from aiohttp.client_exceptions import ClientConnectionError, ClientConnectorError
-import aiohttp
 from channels.db import database_sync_to_async
 from django.conf import settings
 from django.core import exceptions as dex
 from django.utils import timezone
 
-from solr_channel.consumers.JsonRpcConsumer import JsonRpcResultResponse
+from solr_channel.consumers.JsonRpcConsumer import JsonRpcResultResponse, RawJson
+from solr_channel.lib import admission, metrics, tracing
+from solr_channel.lib.authors import author_indexes
+from solr_channel.lib.cursor import CursorStore
+from solr_channel.lib.diskcache import analytics_cache
+from solr_channel.lib.expiry import start_periodic_expiry
+from solr_channel.lib.looplag import start_loop_monitor
+from solr_channel.lib.prefetch import Prefetcher, page_key
+from solr_channel.lib.shmcache import shared_cache
+from solr_channel.lib.subscriptions import pollers, subscription_key
+from solr_channel.lib.solr import get_client, sniff_error
 from solr_channel.models import Graph
 from .JsonRpcExceptions import JsonRpcInvalidParams, JsonRpcInternalError, JsonRpcException
-from .JsonRpcHandlerBase import JsonRpcHandlerBase, command, Availability, chn_command
+from .JsonRpcHandlerBase import JsonRpcHandlerBase, command, Availability, chn_command, Cost
 
-API = f'{settings.SOLR_HOST}/api'
-SOLR = f'{settings.SOLR_HOST}/solr'
+# paths below the solr host, the replica is chosen by the solr client
+API = '/api'
+SOLR = '/solr'
 
 log = logging.getLogger(__name__)
 
@@ -65,6 +75,31 @@ class SolrAuthorCitations(SolrBaseParams):
 class SolrSelect(SolrBaseParams):
     collection: str
     payload: dict
+    prefetch: bool = False
+
+
+@dataclass
+class SolrCursorOpen(SolrBaseParams):
+    collection: str
+    payload: dict
+    rows: int = 100
+
+
+@dataclass
+class SolrCursor(SolrBaseParams):
+    cursor: str
+
+
+@dataclass
+class SolrSubscribe(SolrBaseParams):
+    collection: str
+    payload: dict
+
+
+@dataclass
+class SolrSubscription(SolrBaseParams):
+    subscription: str
+
 
 class Method(Enum):
     DELETE = "DELETE"
@@ -74,6 +109,46 @@ class Method(Enum):
 
 
 
+async def solr_request(endpoint: str, method: Method, json=None, params=None, hedge=False, raw=False):
+    """
+    a request to solr with metrics, raises if solr responded with an error. needs no connection.
+
+    with `raw` the result is the undecoded body as RawJson, it is only searched for an error and sent on as is.
+    """
+    kind = metrics.solr_endpoint_kind(endpoint)
+    start = time.perf_counter()
+    try:
+        with tracing.span('solr', endpoint=kind):
+            result = await get_client().request(endpoint, method.value, json=json, params=params, hedge=hedge,
+                                                raw=raw)
+    except Exception:
+        metrics.solr_requests.inc(endpoint=kind, outcome='failed')
+        raise
+    finally:
+        metrics.solr_latency.observe(time.perf_counter() - start, endpoint=kind)
+    error = await sniff_error(result) if raw else result.get('error', None) if isinstance(result, dict) else None
+    if error is not None:
+        metrics.solr_requests.inc(endpoint=kind, outcome='error')
+        raise JsonRpcInternalError('solr responded with an error', error)
+    metrics.solr_requests.inc(endpoint=kind, outcome='ok')
+    return RawJson(result.decode()) if raw else result
+
+
+async def author_counts(collection: str) -> List[Tuple[str, int]]:
+    """
+    the authors of a collection and their number of publications, for the suggest_author index
+    """
+    config = settings.AUTHOR_SUGGEST
+    payload = {'query': '*:*', 'limit': 0, 'facet': {'authors': {
+        'type': 'terms', 'field': config['FIELD'], 'limit': config['MAX_AUTHORS'], 'mincount': 1,
+    }}}
+    # a facet over every author takes a while, it must not hold up the lookups
+    with admission.solr_class(Cost.EXPENSIVE.value):
+        result = await solr_request(f'{API}/c/{collection}/select', Method.GET, json=payload)
+    buckets = result.get('facets', {}).get('authors', {}).get('buckets', [])
+    return [(bucket['val'], bucket['count']) for bucket in buckets]
+
+
 @database_sync_to_async
 def create_graph(graph: str):
     stored = Graph(graph_str=graph, ctime=timezone.now(), mtime=timezone.now())
@@ -84,7 +159,9 @@ def create_graph(graph: str):
 @database_sync_to_async
 def get_graph_from_db(graph_id):
     try:
-        return Graph.objects.get(id=graph_id)
+        graph = Graph.objects.get(id=graph_id)
+        graph.touch()
+        return graph
     except dex.ObjectDoesNotExist:
         raise JsonRpcInvalidParams(f'no graph with id: {graph_id}')
     except dex.ValidationError as e:
@@ -96,6 +173,7 @@ def store_graph(graph_id, data):
     try:
         graph = Graph.objects.get(id=graph_id)
         graph.graph_str = data
+        graph.mtime = timezone.now()
         graph.save()
         return graph
     except dex.ObjectDoesNotExist:
@@ -104,55 +182,59 @@ def store_graph(graph_id, data):
         raise JsonRpcInvalidParams(str(e))
 
 
+@database_sync_to_async
+def list_graphs_from_db(after, limit):
+    try:
+        return Graph.objects.page(after, limit)
+    except ValueError as e:
+        raise JsonRpcInvalidParams(str(e))
+
+
 class JsonRpcSolrPassthrough(JsonRpcHandlerBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.group_name = ''
+        cursors = getattr(settings, 'CURSORS', {})
+        self.cursors = CursorStore(cursors.get('TTL', 300), cursors.get('MAX_PER_CONNECTION', 10),
+                                   cursors.get('MAX_ROWS', 1000))
+        self.prefetcher = Prefetcher(settings.PREFETCH['MAX_PER_CONNECTION'], settings.PREFETCH['TTL'])
+        # subscription key -> group of its poller
+        self.subscriptions = {}
 
     async def connect(self):
+        if not await self.admit():
+            return
+        # there is no startup hook for the worker, the first connection starts the background tasks
+        start_periodic_expiry()
+        start_loop_monitor()
+        author_indexes().start(settings.AUTHOR_SUGGEST['COLLECTIONS'], author_counts)
         self.group_name = ''.join(random.choice(string.ascii_letters) for _ in range(12))
         await self.channel_layer.group_add(group=self.group_name, channel=self.channel_name)
         await super().connect()
 
     async def disconnect(self, code):
-        await self.channel_layer.group_discard(group=self.group_name, channel=self.channel_name)
+        if self.group_name:
+            await self.channel_layer.group_discard(group=self.group_name, channel=self.channel_name)
         self.group_name = ''
+        self.cursors.clear()
+        self.prefetcher.clear()
+        for key in list(self.subscriptions):
+            await self.unsubscribe(key)
         return await super().disconnect(code)
 
-    def _method(self, m: Method, session):
-        if Method.GET == m:
-            return session.get
-        if Method.POST == m:
-            return session.post
-        if Method.DELETE == m:
-            return session.delete
-        if Method.PUT == m:
-            return session.put
-
-    async def solr_http(self, endpoint: str, method: Method, json=None, params=None):
-        async with aiohttp.ClientSession() as session:
-            async with self._method(method, session)(endpoint, json=json, params=params) as response:
-                log.info(response.request_info)
-                result = await response.json()
-                if 'error' in result:
-                    raise JsonRpcInternalError('solr responded with an error', result['error'])
-                else:
-                    return result
-
-
-    async def get_result_api(self, endpoint: str, method: Method, payload: dict) -> dict:
+    async def solr_http(self, endpoint: str, method: Method, json=None, params=None, hedge=False, raw=False):
+        return await solr_request(endpoint, method, json, params, hedge, raw)
+
+    async def get_result_api(self, endpoint: str, method: Method, payload: dict) -> bytes:
         log.info(f'{method}: {endpoint} {payload}')
-        async with aiohttp.ClientSession() as session:
-            async with self._method(method, session)(endpoint, json=payload) as response:
-                return await response.json()
+        return await get_client().request(endpoint, method.value, json=payload, raw=True)
 
-    async def get_result_solr(self, endpoint: str, method: Method, params: dict) -> dict:
+    async def get_result_solr(self, endpoint: str, method: Method, params: dict) -> bytes:
         log.debug(f'{method}: {endpoint} {params}')
-        async with aiohttp.ClientSession() as session:
-            async with self._method(method, session)(endpoint, params=params) as response:
-                return await response.json()
+        return await get_client().request(endpoint, method.value, params=params, raw=True)
 
     async def handle_exception(self, e: Exception, msg_id: str):
+        from aiohttp.client_exceptions import ClientConnectionError, ClientConnectorError
         if type(e) is ClientConnectionError:
             e = JsonRpcInternalError('could not connect to backend: ' + str(e))
         elif type(e) is ClientConnectorError:
@@ -180,13 +262,14 @@ async def pass_through(self, endpoint: str, method: Method, payload: dict, rqid:
                 raise JsonRpcInvalidParams(f'unsupported method: {method}, must be one of [DELETE, PUT, GET, POST]')
         try:
             result = await self.get_result_api(API + endpoint, method, payload)
+            error = await sniff_error(result)
         except Exception as e:
             return await self.handle_exception(e, rqid)
 
-        if 'error' in result:
-            raise JsonRpcInternalError('solr responded with an error', result['error'])
+        if error is not None:
+            raise JsonRpcInternalError('solr responded with an error', error)
         else:
-            await self.send_response(JsonRpcResultResponse(result,rqid))
+            await self.send_result(RawJson(result.decode()), rqid)
 
     @command(Availability.DEBUG_ONLY, {
         'endpoint': 'the endpoint of the api: i.e. "/collections"',
@@ -207,12 +290,13 @@ async def pass_through_solr(self, endpoint: str, method: Method, payload: dict,
 
         try:
             result = await self.get_result_solr(SOLR + endpoint, method, payload)
+            error = await sniff_error(result)
         except Exception as e:
             return await self.handle_exception(e, rqid)
-        if 'error' in result:
-            raise JsonRpcInternalError('solr responded with an error', result['error'])
+        if error is not None:
+            raise JsonRpcInternalError('solr responded with an error', error)
         else:
-            await self.send_response(JsonRpcResultResponse(result,rqid))
+            await self.send_result(RawJson(result.decode()), rqid)
 
     @command(Availability.PRODUCTION, {
         'graph': 'the graph as string',
@@ -226,7 +310,7 @@ async def store_new_graph(self, graph: str, rqid: str):
 
     @command(Availability.PRODUCTION, {
         'graph_id': 'the uuid of a graph'
-    })
+    }, cost=Cost.CHEAP)
     async def get_graph(self, graph_id: str, rqid: str):
         """
         get a graph from the database
@@ -246,16 +330,105 @@ async def update_graph(self, graph_id: str, data: str, rqid):
         graph = await store_graph(graph_id, data)
         await self.send_response(JsonRpcResultResponse({'uuid': str(graph.id)}, rqid))
 
+    @command(Availability.DEBUG_ONLY, {
+        'after': 'the position returned with the previous page, omit it for the first page',
+        'limit': 'graphs per page, at most 500',
+        'return': 'the graphs, newest first, and the position of the next page, null on the last page'
+    }, cost=Cost.CHEAP)
+    async def list_graphs(self, rqid: str, after: str = '', limit: int = 50):
+        """
+        list the stored graphs, without their contents
+        """
+        if not 0 < limit <= 500:
+            raise JsonRpcInvalidParams('limit must be between 1 and 500')
+        graphs, position = await list_graphs_from_db(after, limit)
+        await self.send_response(JsonRpcResultResponse({
+            'graphs': [{'uuid': str(g.id), 'ctime': g.ctime.isoformat(), 'mtime': g.mtime.isoformat()} for g in graphs],
+            'next': position,
+        }, rqid))
+
+    @command(Availability.PRODUCTION, {
+        'collection': 'the collection to search in',
+        'prefix': 'the beginning of the name or of one of its words, case and accents are ignored',
+        'limit': 'the most authors to return, at most AUTHOR_SUGGEST["TOP_K"]',
+        'return': 'the matching authors as name and number of publications, the most publications first'
+    }, cost=Cost.CHEAP)
+    async def suggest_author(self, collection: str, prefix: str, rqid: str, limit: int = 10):
+        """
+        complete an author's name from memory, without a solr request
+        """
+        if not isinstance(prefix, str):
+            raise JsonRpcInvalidParams('prefix must be a string')
+        if not isinstance(limit, int) or 1 > limit:
+            raise JsonRpcInvalidParams('limit must be a positive number')
+        index = await author_indexes().get(collection, author_counts)
+        await self.send_response(JsonRpcResultResponse({
+            'authors': [{'name': name, 'count': count} for name, count in index.suggest(prefix, limit)],
+        }, rqid))
+
+    async def cached_analytics(self, key: str, compute):
+        """
+        the result of `compute` from the disk cache, computed and stored on a miss
+        """
+        cache = analytics_cache()
+        if cache is None:
+            return await compute()
+        result = await cache.get(key)
+        if result is not None:
+            metrics.analytics_cache.inc(outcome='hit')
+            return result
+        metrics.analytics_cache.inc(outcome='miss')
+        result = await compute()
+        await cache.set(key, result)
+        return result
+
+    async def shared(self, key: str, fetch) -> RawJson:
+        """
+        the raw result of `fetch` from the cache shared by the workers of this host, fetched and stored on a miss
+        """
+        cache = shared_cache()
+        if cache is None:
+            return await fetch()
+        data = cache.get(key)
+        if data is not None:
+            metrics.shared_cache.inc(outcome='hit')
+            return RawJson(data.decode())
+        metrics.shared_cache.inc(outcome='miss')
+        result = await fetch()
+        cache.set(key, result.text.encode())
+        return result
+
+    async def select(self, collection: str, payload: dict) -> RawJson:
+        endpoint = f'{API}/c/{collection}/select'
+        return await self.shared(f'select:{page_key(collection, payload)}',
+                                 lambda: self.solr_http(endpoint, Method.GET, json=payload, hedge=True, raw=True))
+
+    async def prefetched(self, collection: str, payload: dict):
+        task = self.prefetcher.take(collection, payload)
+        if task is None:
+            return None
+        try:
+            result = await task
+        except Exception as e:
+            log.info(f'prefetch failed, fetching again: {e!r}')
+            return None
+        metrics.prefetch_hits.inc()
+        return result
+
     @chn_command(Availability.PRODUCTION, {
         'collection': 'the collection you want to search in',
         'payload': 'the parameters of the search',
+        'prefetch': 'fetch the next page in the background, so it can be served from memory',
         'return': 'the result of the response'
-    })
+    }, deadline=30)
     async def solr_select(self, ev: SolrSelect) -> None:
         collection = ev.collection
         payload = ev.payload
-        endpoint = f'{API}/c/{collection}/select'
-        result = await self.solr_http(endpoint,Method.GET,json=payload)
+        result = await self.prefetched(collection, payload)
+        if result is None:
+            result = await self.select(collection, payload)
+        if ev.prefetch:
+            self.prefetcher.schedule(collection, payload, self.spawn, lambda page: self.select(collection, page))
         log.info(result)
         return result
 
@@ -263,14 +436,16 @@ async def solr_select(self, ev: SolrSelect) -> None:
         'collection': 'the collection to search in',
         'author': 'the author to give positions for',
         'rows': 'the number of publications by this author'
-    })
+    }, cost=Cost.EXPENSIVE, deadline=60)
     async def solr_author_position(self, event: SolrAuthorPosition) -> List[AuthorPosition]:
         """
         Calculate the occuring positions of an author.
         """
-        collection = event.collection
-        author = event.author
-        rows = event.rows
+        key = f'author_position:{event.collection}:{event.author}:{event.rows}'
+        return await self.cached_analytics(key, lambda: self.author_position(event.collection, event.author,
+                                                                             event.rows))
+
+    async def author_position(self, collection: str, author: str, rows: int) -> List[AuthorPosition]:
         expr = f'''
         select(
             rollup(
@@ -313,14 +488,16 @@ async def solr_author_position(self, event: SolrAuthorPosition) -> List[AuthorPo
     @chn_command(Availability.PRODUCTION, {
         'collection': 'the collection to search in',
         'author': 'the author to give citations for',
-    })
+    }, cost=Cost.EXPENSIVE, deadline=60)
     async def solr_author_citations(self, event: SolrAuthorCitations) -> AuthorCitations:
         """
         Returns a list of citation counts and publication years for the author.
         The list is sorted by the citation counts.
         """
-        collection = event.collection
-        author = event.author
+        key = f'author_citations:{event.collection}:{event.author}'
+        return await self.cached_analytics(key, lambda: self.author_citations(event.collection, event.author))
+
+    async def author_citations(self, collection: str, author: str) -> AuthorCitations:
         expr = f'''
             let(echo="citation_count,year",
                 a=search(
@@ -350,8 +527,121 @@ async def solr_author_citations(self, event: SolrAuthorCitations) -> AuthorCitat
     @chn_command(Availability.PRODUCTION, {
         'collection': 'the collection you want to search in',
         'id': 'the document id'
-    })
+    }, cost=Cost.CHEAP, deadline=10)
     async def solr_get(self, event: SolrGet) -> None:
         collection = event.collection
         url = f'{API}/c/{collection}/get'
-        return await self.solr_http(url, Method.GET, json={'params': {'id': event.id}})
+        return await self.shared(f'get:{collection}:{event.id}',
+                                 lambda: self.solr_http(url, Method.GET, json={'params': {'id': event.id}}, hedge=True,
+                                                        raw=True))
+
+    async def cursor_page(self, key: str) -> dict:
+        try:
+            cursor = self.cursors.get(key)
+        except KeyError:
+            raise JsonRpcInvalidParams(f'no such cursor: {key}, it may have expired')
+        # pages have to be fetched one after the other, every request needs the mark of the previous one
+        async with cursor.lock:
+            if cursor.done:
+                return {'cursor': key, 'docs': [], 'done': True}
+            endpoint = f'{API}/c/{cursor.collection}/select'
+            result = await self.solr_http(endpoint, Method.GET, json=cursor.page_request(), hedge=True)
+            next_mark = result.get('nextCursorMark', cursor.mark)
+            cursor.done = next_mark == cursor.mark
+            cursor.mark = next_mark
+            cursor.pages += 1
+            response = result.get('response', {})
+            return {
+                'cursor': key,
+                'docs': response.get('docs', []),
+                'numFound': response.get('numFound'),
+                'page': cursor.pages,
+                'done': cursor.done,
+            }
+
+    @chn_command(Availability.PRODUCTION, {
+        'collection': 'the collection you want to search in',
+        'payload': 'the search as JSON request, offset and limit are ignored',
+        'rows': 'the number of documents per page',
+    }, deadline=30)
+    async def solr_cursor_open(self, event: SolrCursorOpen) -> dict:
+        """
+        Start paging through all results of a search, returns the cursor and the first page.
+        The search is kept on the server, fetch the next pages with solr_cursor_next.
+        """
+        if not isinstance(event.rows, int) or isinstance(event.rows, bool):
+            raise JsonRpcInvalidParams('rows must be an integer')
+        if not 0 < event.rows <= self.cursors.max_rows:
+            raise JsonRpcInvalidParams(f'rows must be between 1 and {self.cursors.max_rows}')
+        try:
+            key = self.cursors.open(event.collection, event.payload, event.rows)
+        except LookupError as e:
+            raise JsonRpcInvalidParams(str(e))
+        return await self.cursor_page(key)
+
+    @chn_command(Availability.PRODUCTION, {
+        'cursor': 'the cursor returned by solr_cursor_open',
+    }, cost=Cost.CHEAP, deadline=30)
+    async def solr_cursor_next(self, event: SolrCursor) -> dict:
+        """
+        The next page of a cursor, done is true once all results were returned.
+        """
+        return await self.cursor_page(event.cursor)
+
+    @chn_command(Availability.PRODUCTION, {
+        'cursor': 'the cursor returned by solr_cursor_open',
+    }, cost=Cost.CHEAP)
+    async def solr_cursor_close(self, event: SolrCursor) -> dict:
+        """
+        Forget a cursor, cursors expire on their own if they are not used.
+        """
+        return {'cursor': event.cursor, 'closed': self.cursors.close(event.cursor)}
+
+    async def unsubscribe(self, key: str) -> bool:
+        group = self.subscriptions.pop(key, None)
+        if group is None:
+            return False
+        pollers().unsubscribe(key, self.channel_name)
+        await self.channel_layer.group_discard(group=group, channel=self.channel_name)
+        return True
+
+    @chn_command(Availability.PRODUCTION, {
+        'collection': 'the collection you want to search in',
+        'payload': 'the search as JSON request, like for solr_select',
+        'return': 'the subscription, the version and the current result',
+    }, deadline=30)
+    async def subscribe_query(self, event: SolrSubscribe) -> dict:
+        """
+        Get the result of a search now and whenever it changes.
+        Changes arrive as query_update notifications with the subscription, a version and the result (or an error).
+        All connections that subscribe to the same search share one poller on the server.
+        """
+        key = subscription_key(event.collection, event.payload)
+        if key not in self.subscriptions and settings.SUBSCRIPTIONS['MAX_PER_CONNECTION'] <= len(self.subscriptions):
+            raise JsonRpcInvalidParams(f'at most {settings.SUBSCRIPTIONS["MAX_PER_CONNECTION"]} subscriptions '
+                                       f'may be open, unsubscribe first')
+        endpoint = f'{API}/c/{event.collection}/select'
+        poller = pollers().subscribe(key, self.channel_name,
+                                     lambda: solr_request(endpoint, Method.GET, json=event.payload, hedge=True),
+                                     self.channel_layer)
+        if key not in self.subscriptions:
+            self.subscriptions[key] = poller.group
+            await self.channel_layer.group_add(group=poller.group, channel=self.channel_name)
+        return await poller.current()
+
+    @chn_command(Availability.PRODUCTION, {
+        'subscription': 'the subscription returned by subscribe_query',
+    }, cost=Cost.CHEAP)
+    async def unsubscribe_query(self, event: SolrSubscription) -> dict:
+        """
+        Stop the updates of a subscription.
+        """
+        return {'subscription': event.subscription, 'unsubscribed': await self.unsubscribe(event.subscription)}
+
+    async def query_update(self, event: dict):
+        """
+        a changed result from a poller, see solr_channel.lib.subscriptions
+        """
+        if event['subscription'] not in self.subscriptions:
+            return
+        await self.send_notification('query_update', {key: value for key, value in event.items() if key != 'type'})
@@ -0,0 +1,277 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Tuple, Union
+
+from django.conf import settings
+
+from solr_channel.lib import metrics
+
+log = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """
+    the process is too busy to take this request, the client should try again later
+    """
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        """
+        :param rate: tokens added per second
+        :param burst: maximum tokens, i.e. how many requests may arrive at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_acquire(self, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def retry_after(self, cost: float = 1.0) -> float:
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+
+class ConcurrencyLimiter:
+    """
+    caps the requests in flight, a bounded number of requests may wait for a bounded time, the rest is rejected.
+    """
+
+    def __init__(self, limit: int, max_waiting: int, timeout: float):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.waiting = 0
+        self.active = 0
+        self._semaphore = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # created on first use, so it belongs to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    @property
+    def saturated(self) -> bool:
+        return self.max_waiting // 2 <= self.waiting
+
+    async def __aenter__(self):
+        if self.semaphore.locked():
+            if self.max_waiting <= self.waiting:
+                raise Overloaded(f'{self.waiting} requests are already waiting for solr')
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                raise Overloaded(f'waited {self.timeout}s for solr')
+            finally:
+                self.waiting -= 1
+        else:
+            await self.semaphore.acquire()
+        self.active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.active -= 1
+        self.semaphore.release()
+
+
+# the class of the solr requests made by the running command, its cost (see JsonRpcHandlerBase.Cost)
+request_class = contextvars.ContextVar('solr_request_class', default='normal')
+
+
+@contextmanager
+def solr_class(name: str):
+    """
+    solr requests made inside are scheduled in the class `name`, this includes tasks started inside
+    """
+    token = request_class.set(name)
+    try:
+        yield
+    finally:
+        request_class.reset(token)
+
+
+class RequestClass:
+    def __init__(self, name: str, weight: float, share: float, limit: int):
+        """
+        :param weight: how many requests of this class are started per request of a class with weight 1,
+            while both have requests waiting
+        :param share: the fraction of the slots this class may occupy at once
+        """
+        self.name = name
+        self.stride = 1.0 / weight
+        self.cap = max(1, int(limit * share))
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        # stride scheduling: the class with the lowest pass goes next, every start advances it by the stride
+        self.pass_ = 0.0
+
+
+class PriorityLimiter:
+    """
+    caps the requests in flight like ConcurrencyLimiter, but every request belongs to a class (from request_class)
+    with its own share of the slots. when a slot frees up, the waiting classes take turns by their weight,
+    so a queue of expensive requests can neither fill all slots nor delay cheap ones for long.
+    """
+
+    def __init__(self, limit: int, max_waiting: int, timeout: float, classes: Dict[str, Tuple[float, float]],
+                 default: str = 'normal'):
+        """
+        :param classes: maps a class name to (weight, share)
+        """
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.classes = {name: RequestClass(name, weight, share, limit) for name, (weight, share) in classes.items()}
+        if default not in self.classes:
+            self.classes[default] = RequestClass(default, 1.0, 1.0, limit)
+        self.default = default
+        self.active = 0
+        self.waiting = 0
+        self.clock = 0.0
+
+    @property
+    def saturated(self) -> bool:
+        return self.max_waiting // 2 <= self.waiting
+
+    def _class(self) -> RequestClass:
+        return self.classes.get(request_class.get(), self.classes[self.default])
+
+    def _start(self, cls: RequestClass):
+        cls.active += 1
+        self.active += 1
+        self.clock = cls.pass_
+        cls.pass_ += cls.stride
+
+    def _dispatch(self):
+        while self.active < self.limit:
+            ready = [cls for cls in self.classes.values() if cls.waiters and cls.active < cls.cap]
+            if not ready:
+                return
+            cls = min(ready, key=lambda c: c.pass_)
+            waiter = cls.waiters.popleft()
+            if waiter.done():
+                continue
+            self._start(cls)
+            waiter.set_result(cls)
+
+    async def acquire(self) -> RequestClass:
+        cls = self._class()
+        if self.active < self.limit and cls.active < cls.cap and not cls.waiters:
+            self._start(cls)
+            return cls
+        if self.max_waiting <= self.waiting:
+            raise Overloaded(f'{self.waiting} requests are already waiting for solr')
+        if not cls.waiters:
+            # an idle class must not catch up on the turns it did not need
+            cls.pass_ = max(cls.pass_, self.clock)
+        waiter = asyncio.get_event_loop().create_future()
+        cls.waiters.append(waiter)
+        self.waiting += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted while we gave up, pass it on
+                self.release(waiter.result())
+            else:
+                waiter.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                raise Overloaded(f'waited {self.timeout}s for solr')
+            raise
+        finally:
+            self.waiting -= 1
+
+    def release(self, cls: RequestClass):
+        cls.active -= 1
+        self.active -= 1
+        self._dispatch()
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # the block runs in the same context, so it is the class we acquired for
+        self.release(self._class())
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        # the metrics view calls this from another thread while the loop adds and removes waiters
+        return {name: {'active': cls.active, 'waiting': sum(1 for w in list(cls.waiters) if not w.done()),
+                       'cap': cls.cap} for name, cls in list(self.classes.items())}
+
+
+def _config() -> dict:
+    return getattr(settings, 'ADMISSION', {})
+
+
+_solr_limiter = None
+connections = 0
+
+
+def connection_opened():
+    global connections
+    connections += 1
+
+
+def connection_closed():
+    global connections
+    connections -= 1
+
+
+def solr_limiter() -> Union[ConcurrencyLimiter, PriorityLimiter]:
+    """
+    the cap on concurrent solr requests of this process, scheduled by class if ADMISSION['SOLR_CLASSES'] is set
+    """
+    global _solr_limiter
+    if _solr_limiter is None:
+        config = _config()
+        limit = config.get('MAX_SOLR_CONCURRENCY', 64)
+        max_waiting = config.get('MAX_SOLR_QUEUE', 256)
+        timeout = config.get('SOLR_QUEUE_TIMEOUT', 5.0)
+        classes = config.get('SOLR_CLASSES', None)
+        if classes:
+            _solr_limiter = PriorityLimiter(limit, max_waiting, timeout, classes)
+            metrics.REGISTRY.add_collector(collect_solr_classes)
+        else:
+            _solr_limiter = ConcurrencyLimiter(limit, max_waiting, timeout)
+    return _solr_limiter
+
+
+def collect_solr_classes():
+    for name, stats in _solr_limiter.stats().items():
+        metrics.solr_class_active.set(stats['active'], request_class=name)
+        metrics.solr_class_waiting.set(stats['waiting'], request_class=name)
+
+
+def should_shed_connection() -> Tuple[bool, str]:
+    """
+    whether a new connection should be turned away, and why
+    """
+    max_connections = _config().get('MAX_CONNECTIONS', None)
+    if max_connections is not None and max_connections <= connections:
+        return True, f'{connections} connections open'
+    if solr_limiter().saturated:
+        return True, f'{solr_limiter().waiting} solr requests waiting'
+    return False, ''
+
+
+def make_buckets() -> Dict[str, TokenBucket]:
+    """
+    one bucket per cost class, for a new connection
+    """
+    limits = _config().get('RATE_LIMITS', {})
+    return {cost: TokenBucket(rate, burst) for cost, (rate, burst) in limits.items()}
@@ -0,0 +1,212 @@
+"""
+author name completion from memory, see suggest_author.
+
+every collection gets an index of its author names and their publication counts, fetched from a solr facet.
+the index is a sorted array of the names, folded to lowercase without accents, and of every word in them,
+so "mül" finds "Anna Müller" as well as "Müller, Anna". a prefix is a range of that array found by bisection.
+the best authors of the prefixes that match many names are computed when the index is built, smaller ranges
+are scanned when they are asked for.
+"""
+import asyncio
+import heapq
+import logging
+import time
+import unicodedata
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from solr_channel.lib import metrics
+
+log = logging.getLogger(__name__)
+
+# sorts after every character of a folded name
+END = chr(0x10ffff)
+
+# building an index is CPU bound, one at a time keeps the other cores for the event loop
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='authors')
+
+
+def fold(text: str) -> str:
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).strip()
+
+
+def word_starts(folded: str) -> Iterable[str]:
+    """
+    the name and the rest of it after every word boundary
+    """
+    yield folded
+    for n in range(1, len(folded)):
+        if not folded[n - 1].isalnum() and folded[n].isalnum():
+            yield folded[n:]
+
+
+class AuthorIndex:
+    def __init__(self, authors: Iterable[Tuple[str, int]], top_k: int = 10, scan_limit: int = 512):
+        """
+        :param authors: names and their publication counts
+        :param top_k: the most authors a suggestion can have
+        :param scan_limit: prefixes that match more entries than this have their best authors computed up front
+        """
+        self.top_k = top_k
+        self.scan_limit = scan_limit
+        self.names: List[str] = []
+        self.counts: List[int] = []
+        entries = []
+        for name, count in authors:
+            author = len(self.names)
+            self.names.append(name)
+            self.counts.append(count)
+            entries.extend((key, author) for key in set(word_starts(fold(name))) if key)
+        entries.sort()
+        self.keys = [key for key, _ in entries]
+        self.authors = [author for _, author in entries]
+        self.top: Dict[str, List[int]] = {}
+        self._precompute()
+        self.built = time.time()
+
+    def __len__(self):
+        return len(self.names)
+
+    def _best(self, lo: int, hi: int, k: int) -> List[int]:
+        # an author is in the range once per matching word, i.e. "li" and "Li Li"
+        return heapq.nlargest(k, set(self.authors[lo:hi]), key=self.counts.__getitem__)
+
+    def _precompute(self):
+        stack = [(0, 0, len(self.keys))]
+        while stack:
+            depth, lo, hi = stack.pop()
+            if hi - lo <= self.scan_limit:
+                continue
+            self.top[self.keys[lo][:depth]] = self._best(lo, hi, self.top_k)
+            n = lo
+            while n < hi:
+                key = self.keys[n]
+                if len(key) <= depth:
+                    # the prefix itself, it has no longer prefix below it
+                    n += 1
+                    continue
+                end = bisect_left(self.keys, key[:depth + 1] + END, n, hi)
+                stack.append((depth + 1, n, end))
+                n = end
+
+    def suggest(self, prefix: str, limit: int = None) -> List[Tuple[str, int]]:
+        """
+        the authors with the most publications whose name or one of its words starts with `prefix`
+        """
+        limit = self.top_k if limit is None else min(limit, self.top_k)
+        key = fold(prefix)
+        best = self.top.get(key)
+        if best is None:
+            lo = bisect_left(self.keys, key)
+            hi = bisect_left(self.keys, key + END, lo)
+            best = self._best(lo, hi, limit)
+        return [(self.names[author], self.counts[author]) for author in best[:limit]]
+
+    def stats(self) -> dict:
+        return {'authors': len(self.names), 'keys': len(self.keys), 'precomputed': len(self.top),
+                'built': self.built}
+
+
+# gets the collection and returns its authors with their publication counts
+AuthorSource = Callable[[str], Awaitable[List[Tuple[str, int]]]]
+
+
+class AuthorIndexes:
+    """
+    the indexes of this process, one per collection, rebuilt every `refresh` seconds in the background
+    """
+
+    def __init__(self, refresh: float, top_k: int, scan_limit: int):
+        self.refresh = refresh
+        self.top_k = top_k
+        self.scan_limit = scan_limit
+        self.indexes: Dict[str, AuthorIndex] = {}
+        self.building: Dict[str, asyncio.Future] = {}
+        self.tasks: Dict[str, asyncio.Future] = {}
+        self.started = False
+
+    async def build(self, collection: str, fetch: AuthorSource) -> AuthorIndex:
+        start = time.perf_counter()
+        authors = await fetch(collection)
+        index = await asyncio.get_event_loop().run_in_executor(_executor, AuthorIndex, authors, self.top_k,
+                                                               self.scan_limit)
+        self.indexes[collection] = index
+        log.info(f'indexed {len(index)} authors of {collection} in {time.perf_counter() - start:.1f}s')
+        return index
+
+    async def get(self, collection: str, fetch: AuthorSource) -> AuthorIndex:
+        """
+        the index of the collection, the first caller of a collection that is not indexed yet waits for it
+        """
+        index = self.indexes.get(collection)
+        if index is not None:
+            return index
+        building = self.building.get(collection)
+        if building is None:
+            building = self.building[collection] = asyncio.ensure_future(self.build(collection, fetch))
+            building.add_done_callback(lambda _: self.building.pop(collection, None))
+        # a cancelled caller must not cancel the build the others wait for
+        index = await asyncio.shield(building)
+        self.keep_fresh(collection, fetch)
+        return index
+
+    def keep_fresh(self, collection: str, fetch: AuthorSource):
+        task = self.tasks.get(collection)
+        if task is None or task.done():
+            self.tasks[collection] = asyncio.ensure_future(self._refresh_loop(collection, fetch))
+
+    async def _refresh_loop(self, collection: str, fetch: AuthorSource):
+        while True:
+            await asyncio.sleep(self.refresh)
+            try:
+                await self.build(collection, fetch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the old index stays in place
+                log.warning(f'rebuilding the author index of {collection} failed: {e!r}')
+
+    def start(self, collections: Iterable[str], fetch: AuthorSource):
+        """
+        build the indexes of the collections in the background, once per process. a collection that fails is
+        built again when it is asked for.
+        """
+        if self.started:
+            return
+        self.started = True
+        for collection in collections:
+            self.spawn_build(collection, fetch)
+
+    def spawn_build(self, collection: str, fetch: AuthorSource):
+        async def build():
+            try:
+                await self.get(collection, fetch)
+            except Exception as e:
+                log.warning(f'building the author index of {collection} failed: {e!r}')
+
+        asyncio.ensure_future(build())
+
+    def collect_metrics(self):
+        # a copy, indexes are added by the loop while the metrics view renders in another thread
+        for collection, index in list(self.indexes.items()):
+            metrics.author_index_size.set(len(index), collection=collection)
+            metrics.author_index_age.set(time.time() - index.built, collection=collection)
+
+
+_indexes: Optional[AuthorIndexes] = None
+
+
+def author_indexes() -> AuthorIndexes:
+    """
+    the author indexes of this process, configured by settings.AUTHOR_SUGGEST
+    """
+    global _indexes
+    if _indexes is None:
+        config = settings.AUTHOR_SUGGEST
+        _indexes = AuthorIndexes(config['REFRESH'], config['TOP_K'], config['SCAN_LIMIT'])
+        metrics.REGISTRY.add_collector(_indexes.collect_metrics)
+    return _indexes
@@ -0,0 +1,58 @@
+import asyncio
+import functools
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+log = logging.getLogger(__name__)
+
+# zlib and zstandard release the GIL while they work, so a few threads keep the event loop free
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='compress')
+
+
+def _deflate(level: int) -> Callable[[bytes], bytes]:
+    # zlib format, what DecompressionStream('deflate') in the browser expects
+    return lambda data: zlib.compress(data, level)
+
+
+def _zstd(level: int) -> Callable[[bytes], bytes]:
+    import zstandard
+    # a ZstdCompressor must not be shared between threads, creating one is cheap compared to compressing
+    return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+
+
+@functools.lru_cache(maxsize=None)
+def algorithms() -> Dict[str, Callable[[int], Callable[[bytes], bytes]]]:
+    # looked up on the first negotiation, not at import
+    available = {'deflate': _deflate}
+    try:
+        import zstandard
+        available['zstd'] = _zstd
+    except ImportError:
+        pass
+    return available
+
+
+DEFAULT_LEVELS = {'deflate': 6, 'zstd': 3}
+
+
+class Compression:
+    """
+    the compression a client negotiated: responses longer than `threshold` bytes are compressed
+    """
+
+    def __init__(self, algorithm: str, threshold: int, level: int = None):
+        available = algorithms()
+        if not isinstance(algorithm, str) or algorithm not in available:
+            raise ValueError(f'unsupported compression: {algorithm}, must be one of {sorted(available)}')
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.level = DEFAULT_LEVELS[algorithm] if level is None else level
+        self._compress = available[algorithm](self.level)
+
+    async def compress(self, data: bytes) -> bytes:
+        return await asyncio.get_event_loop().run_in_executor(_executor, self._compress, data)
+
+    def describe(self) -> dict:
+        return {'algorithm': self.algorithm, 'threshold': self.threshold, 'level': self.level}
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict
+
+log = logging.getLogger(__name__)
+
+# solr's uniqueKey, cursors need it as the last sort criterion
+UNIQUE_KEY = 'id'
+
+
+def cursor_sort(sort: str) -> str:
+    """
+    cursorMark only works if the sort ends with the uniqueKey, add it if the client did not
+    """
+    if not sort:
+        return f'{UNIQUE_KEY} asc'
+    fields = [clause.split()[0] for clause in sort.split(',') if clause.strip()]
+    if UNIQUE_KEY in fields:
+        return sort
+    return f'{sort}, {UNIQUE_KEY} asc'
+
+
+@dataclass
+class CursorSession:
+    collection: str
+    query: dict
+    rows: int
+    expires: float
+    mark: str = '*'
+    done: bool = False
+    pages: int = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def page_request(self) -> dict:
+        """
+        the JSON request for the next page, deep paging is done by the cursor mark instead of an offset
+        """
+        params = dict(self.query.get('params', {}))
+        params['cursorMark'] = self.mark
+        return {**self.query, 'limit': self.rows, 'params': params}
+
+
+class CursorStore:
+    """
+    the cursor sessions of one connection
+    """
+
+    def __init__(self, ttl: float, max_sessions: int, max_rows: int = 1000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_rows = max_rows
+        self.sessions: Dict[str, CursorSession] = {}
+
+    def expire(self):
+        now = time.monotonic()
+        for key in [key for key, session in self.sessions.items() if session.expires < now]:
+            log.debug(f'cursor {key} expired')
+            del self.sessions[key]
+
+    def open(self, collection: str, payload: dict, rows: int) -> str:
+        self.expire()
+        if self.max_sessions <= len(self.sessions):
+            raise LookupError(f'at most {self.max_sessions} cursors may be open, close one first')
+        query = {key: value for key, value in payload.items() if key not in ('offset', 'limit')}
+        query['sort'] = cursor_sort(query.get('sort', ''))
+        params = {key: value for key, value in query.get('params', {}).items() if key not in ('start', 'rows')}
+        if params:
+            query['params'] = params
+        else:
+            query.pop('params', None)
+        key = uuid.uuid4().hex
+        self.sessions[key] = CursorSession(collection, query, rows, time.monotonic() + self.ttl)
+        return key
+
+    def get(self, key: str) -> CursorSession:
+        self.expire()
+        session = self.sessions[key]
+        session.expires = time.monotonic() + self.ttl
+        return session
+
+    def close(self, key: str) -> bool:
+        return self.sessions.pop(key, None) is not None
+
+    def clear(self):
+        self.sessions.clear()
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+'''
+
+
+class DiskCache:
+    """
+    a JSON value cache in a SQLite file that survives restarts, with a TTL per entry and a cap on the total size.
+    when the cap is reached, the least recently used entries are evicted.
+
+    all access goes through one thread that owns the connection, the event loop never waits for the disk.
+    several processes may share the file, so the total size is read from it in the transaction that evicts.
+    """
+
+    def __init__(self, path: str, ttl: float, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._connection: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='diskcache')
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def get_sync(self, key: str) -> Optional[Any]:
+        now = time.time()
+        row = self.connection.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires < now:
+            self._delete(key)
+            return None
+        self.connection.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(value)
+
+    def set_sync(self, key: str, value: Any):
+        data = json.dumps(value).encode()
+        if self.max_bytes < len(data):
+            log.info(f'not caching {key}, {len(data)} bytes is more than the whole cache')
+            return
+        now = time.time()
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('INSERT OR REPLACE INTO cache (key, value, size, expires, accessed) '
+                               'VALUES (?, ?, ?, ?, ?)', (key, data, len(data), now + self.ttl, now))
+            self._evict(now)
+            connection.execute('COMMIT')
+        except Exception:
+            try:
+                connection.execute('ROLLBACK')
+            finally:
+                # start over with a fresh connection, even if the rollback failed as well
+                self._connection = None
+                connection.close()
+            raise
+
+    def _delete(self, key: str):
+        self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def _evict(self, now: float):
+        """
+        must run in a write transaction, the size then includes what the other processes stored
+        """
+        self.connection.execute('DELETE FROM cache WHERE expires < ?', (now,))
+        size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        # oldest first, until we are below 90% so we don't evict on every insert
+        target = self.max_bytes * 0.9
+        evicted = 0
+        while size > target:
+            oldest = self.connection.execute('SELECT key, size FROM cache ORDER BY accessed LIMIT 100').fetchall()
+            if not oldest:
+                break
+            for key, entry_size in oldest:
+                if size <= target:
+                    break
+                self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+                size -= entry_size
+                evicted += 1
+        log.info(f'evicted {evicted} entries, {size} bytes left')
+
+    async def get(self, key: str) -> Optional[Any]:
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, self.get_sync, key)
+        except (sqlite3.Error, ValueError) as e:
+            # the cache is an optimization, never fail a request because of it
+            log.exception(e)
+            return None
+
+    async def set(self, key: str, value: Any):
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self.set_sync, key, value)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            log.exception(e)
+
+
+_analytics_cache: Optional[DiskCache] = None
+
+
+def analytics_cache() -> Optional[DiskCache]:
+    """
+    the cache for author analytics, configured by settings.ANALYTICS_CACHE. None if it is disabled.
+    """
+    global _analytics_cache
+    config = getattr(settings, 'ANALYTICS_CACHE', None)
+    if not config:
+        return None
+    if _analytics_cache is None:
+        _analytics_cache = DiskCache(config['PATH'], config['TTL'], config['MAX_BYTES'])
+    return _analytics_cache
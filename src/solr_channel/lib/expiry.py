@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, asdict
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from solr_channel.lib import metrics
+
+log = logging.getLogger(__name__)
+
+# sqlite's auto_vacuum modes
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+@dataclass
+class ExpiryStats:
+    deleted: int = 0
+    batches: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+    free_pages: int = 0
+    vacuumed: bool = False
+    seconds: float = 0.0
+
+    @property
+    def reclaimed(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+    def as_dict(self) -> dict:
+        return {**asdict(self), 'reclaimed': self.reclaimed}
+
+
+def _pragma(name: str) -> int:
+    with connection.cursor() as cursor:
+        cursor.execute(f'PRAGMA {name}')
+        return cursor.fetchone()[0]
+
+
+def database_bytes() -> int:
+    if connection.vendor != 'sqlite':
+        return 0
+    return _pragma('page_count') * _pragma('page_size')
+
+
+def enable_incremental_vacuum():
+    """
+    switch the database to auto_vacuum=INCREMENTAL, this rewrites the whole file once
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+
+
+def incremental_vacuum(pages: int = 0) -> bool:
+    """
+    give free pages back to the filesystem, all of them if `pages` is 0.
+    only possible if the database uses auto_vacuum=INCREMENTAL, otherwise the free pages are reused by later inserts.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    if _pragma('auto_vacuum') != AUTO_VACUUM_INCREMENTAL:
+        log.info('the database does not use auto_vacuum=INCREMENTAL, free pages stay in the file')
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+        # the pragma frees one page per step of the statement
+        cursor.fetchall()
+    return True
+
+
+def expire_graphs(max_age: float, batch_size: int, pause: float = 0.0, vacuum: bool = True,
+                  vacuum_pages: int = 0, dry_run: bool = False) -> ExpiryStats:
+    """
+    delete graphs that were neither modified nor read for `max_age` seconds, `batch_size` rows per transaction.
+    each transaction holds the write lock only briefly, and between batches requests get their turn for `pause` seconds.
+    """
+    from solr_channel.models import Graph
+    started = time.monotonic()
+    stats = ExpiryStats(bytes_before=database_bytes())
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    # the access time is only written once a day, so graphs are kept up to a day longer than max_age
+    stale = Graph.objects.filter(Q(atime__isnull=True) | Q(atime__lt=cutoff), mtime__lt=cutoff)
+    if dry_run:
+        stats.deleted = stale.count()
+    else:
+        while True:
+            with transaction.atomic():
+                ids = list(stale.order_by('mtime').values_list('id', flat=True)[:batch_size])
+                if ids:
+                    Graph.objects.filter(id__in=ids).delete()
+            if not ids:
+                break
+            stats.deleted += len(ids)
+            stats.batches += 1
+            metrics.graphs_expired.inc(len(ids))
+            if len(ids) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        if vacuum and stats.deleted:
+            stats.vacuumed = incremental_vacuum(vacuum_pages)
+    stats.bytes_after = database_bytes()
+    if connection.vendor == 'sqlite':
+        stats.free_pages = _pragma('freelist_count')
+    stats.seconds = time.monotonic() - started
+    log.info(f'expired {stats.deleted} graphs unused since {cutoff.isoformat()} in {stats.batches} batches, '
+             f'reclaimed {stats.reclaimed} bytes, {stats.free_pages} free pages left, took {stats.seconds:.2f}s')
+    return stats
+
+
+def expire_configured(**overrides) -> ExpiryStats:
+    config = {**settings.GRAPH_EXPIRY, **overrides}
+    return expire_graphs(config['MAX_AGE'], config['BATCH_SIZE'], config['BATCH_PAUSE'],
+                         vacuum_pages=config['VACUUM_PAGES'])
+
+
+_expiry_task: Optional[asyncio.Future] = None
+
+
+async def _expiry_loop(interval: float):
+    from channels.db import database_sync_to_async
+    # several workers share the database, don't let them all start at the same time
+    await asyncio.sleep(random.uniform(0, interval))
+    while True:
+        try:
+            await database_sync_to_async(expire_configured)()
+        except Exception as e:
+            log.exception(e)
+        await asyncio.sleep(interval)
+
+
+def start_periodic_expiry():
+    """
+    run the expiry every GRAPH_EXPIRY['INTERVAL'] seconds in this process, if an interval is configured
+    """
+    global _expiry_task
+    interval = settings.GRAPH_EXPIRY.get('INTERVAL')
+    if not interval or (_expiry_task is not None and not _expiry_task.done()):
+        return
+    _expiry_task = asyncio.ensure_future(_expiry_loop(interval))
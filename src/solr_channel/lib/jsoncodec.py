@@ -0,0 +1,18 @@
+from typing import Optional
+
+from django.conf import settings
+
+from channels_zeromq.codec import JsonCodec, DEFAULT_THRESHOLD
+
+_codec: Optional[JsonCodec] = None
+
+
+def json_codec() -> JsonCodec:
+    """
+    the codec for websocket frames and solr responses, configured by settings.JSON_OFFLOAD
+    """
+    global _codec
+    if _codec is None:
+        config = getattr(settings, 'JSON_OFFLOAD', None) or {}
+        _codec = JsonCodec(config.get('THRESHOLD', DEFAULT_THRESHOLD))
+    return _codec
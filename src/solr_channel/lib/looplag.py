@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+from django.conf import settings
+
+from solr_channel.lib import metrics
+
+log = logging.getLogger(__name__)
+
+
+def _percentile(ordered, p: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class LagMonitor:
+    """
+    measures how late the event loop runs a callback that should run every `interval` seconds.
+    everything (websockets, channel layer, solr requests) shares one loop, so the lag is added to every request.
+
+    a watchdog thread notices when the loop did not come back for `threshold` seconds and records the stack
+    of the loop's thread, which is whatever blocks it.
+    """
+
+    def __init__(self, interval: float = 0.05, threshold: float = 0.1, window: int = 1200, max_stalls: int = 20,
+                 stack_depth: int = 30):
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self.lags = deque(maxlen=window)
+        self.stalls = deque(maxlen=max_stalls)
+        self.heartbeat = time.monotonic()
+        self.task: Optional[asyncio.Future] = None
+        self._thread_id = None
+        self._stall = None
+        self._stopped = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        """
+        must be called from the thread that runs the loop
+        """
+        if self.task is not None and not self.task.done():
+            return
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.ensure_future(self._tick())
+        self._watchdog = threading.Thread(target=self._watch, name='looplag', daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _tick(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            beat = self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            lag = max(0.0, loop.time() - expected)
+            self.lags.append(lag)
+            metrics.loop_lag.observe(lag)
+            stall = self._stall
+            if stall is not None and stall['heartbeat'] == beat:
+                stall['seconds'] = lag
+                metrics.loop_stalls.inc()
+                log.warning(f'event loop blocked for {lag * 1000:.0f}ms, it was busy in:\n{stall["stack"]}')
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 4):
+            beat = self.heartbeat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or (self._stall is not None and self._stall['heartbeat'] == beat):
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            stack = ''.join(traceback.format_stack(frame, limit=self.stack_depth)) if frame is not None else ''
+            # one sample per stall, the loop fills in how long it took once it runs again
+            self._stall = {'time': time.time(), 'heartbeat': beat, 'seconds': None, 'stack': stack}
+            self.stalls.append(self._stall)
+
+    def percentiles(self, points=(50, 90, 99)) -> dict:
+        if not self.lags:
+            return {}
+        ordered = sorted(self.lags)
+        result = {f'p{p}': _percentile(ordered, p) for p in points}
+        result['max'] = ordered[-1]
+        return result
+
+    def stats(self) -> dict:
+        return {
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'samples': len(self.lags),
+            'lag': self.percentiles(),
+            'stalls': [{key: value for key, value in stall.items() if key != 'heartbeat'}
+                       for stall in list(self.stalls)],
+        }
+
+    def collect_metrics(self):
+        for quantile, value in self.percentiles().items():
+            metrics.loop_lag_quantile.set(value, quantile=quantile)
+
+
+_monitor: Optional[LagMonitor] = None
+
+
+def loop_monitor() -> Optional[LagMonitor]:
+    """
+    the monitor of this process, configured by settings.LOOP_MONITOR. None if it is disabled.
+    """
+    global _monitor
+    config = getattr(settings, 'LOOP_MONITOR', None)
+    if not config:
+        return None
+    if _monitor is None:
+        _monitor = LagMonitor(config['INTERVAL'], config['THRESHOLD'], config['WINDOW'], config['MAX_STALLS'])
+        metrics.REGISTRY.add_collector(_monitor.collect_metrics)
+    return _monitor
+
+
+def start_loop_monitor():
+    monitor = loop_monitor()
+    if monitor is not None:
+        monitor.start()
@@ -0,0 +1,243 @@
+import bisect
+import collections
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Tuple
+
+log = logging.getLogger(__name__)
+
+# in seconds, from a cached solr_get to a full /export
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        """
+        rendered in a thread of the metrics view while the event loop keeps updating, so iterate a copy
+        """
+        return []
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = collections.Counter()
+
+    def inc(self, amount=1, **labels):
+        self.values[self._key(labels)] += amount
+
+    def advance(self, total, **labels):
+        """
+        follow a total that is counted elsewhere, the counter never goes down
+        """
+        key = self._key(labels)
+        self.values[key] = max(self.values[key], total)
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield f'{self.name}{_labels(self.labelnames, key)} {value}'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield f'{self.name}{_labels(self.labelnames, key)} {value}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: counts per bucket (not cumulative), sum and count
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        counts, _, _ = entry = self.values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                yield f'{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}'
+            le = 'le="+Inf"'
+            yield f'{self.name}_bucket{_labels(self.labelnames, key, le)} {count}'
+            yield f'{self.name}_sum{_labels(self.labelnames, key)} {total}'
+            yield f'{self.name}_count{_labels(self.labelnames, key)} {count}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f'metric already registered: {metric.name}')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """
+        :param collector: called before every render, updates gauges that are sampled instead of tracked
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                log.exception(e)
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+rpc_requests = REGISTRY.counter('sonne_rpc_requests_total', 'JSON-RPC requests by method and outcome',
+                                ('method', 'outcome'))
+rpc_latency = REGISTRY.histogram('sonne_rpc_request_seconds', 'time from dispatch to response per method',
+                                 ('method',))
+rpc_response_bytes = REGISTRY.counter('sonne_rpc_response_bytes_total', 'encoded JSON-RPC responses, uncompressed',
+                                      ('encoding',))
+rpc_wire_bytes = REGISTRY.counter('sonne_rpc_wire_bytes_total', 'JSON-RPC responses as sent to the client',
+                                  ('encoding',))
+rpc_shed_connections = REGISTRY.counter('sonne_rpc_shed_connections_total',
+                                        'connections turned away because the process was saturated')
+prefetch_hits = REGISTRY.counter('sonne_prefetch_hits_total', 'solr_select pages served from a prefetch')
+analytics_cache = REGISTRY.counter('sonne_analytics_cache_total', 'author analytics served from the disk cache',
+                                   ('outcome',))
+author_index_size = REGISTRY.gauge('sonne_author_index_authors', 'authors in the suggest_author index per collection',
+                                   ('collection',))
+author_index_age = REGISTRY.gauge('sonne_author_index_age_seconds', 'time since the author index was built',
+                                  ('collection',))
+graphs_expired = REGISTRY.counter('sonne_graphs_expired_total',
+                                  'graphs deleted because nobody read or modified them for too long')
+query_polls = REGISTRY.counter('sonne_query_polls_total', 'polls of subscribed queries by outcome', ('outcome',))
+query_pollers = REGISTRY.gauge('sonne_query_pollers', 'distinct subscribed queries polled by this process')
+query_subscribers = REGISTRY.gauge('sonne_query_subscribers', 'query subscriptions of all connections')
+shared_cache = REGISTRY.counter('sonne_shared_cache_total', 'solr results looked up in the cache shared by the workers',
+                                ('outcome',))
+recorded_requests = REGISTRY.counter('sonne_recorded_requests_total', 'requests of sampled connections by outcome',
+                                     ('outcome',))
+solr_requests = REGISTRY.counter('sonne_solr_requests_total', 'requests sent to solr by endpoint kind and outcome',
+                                 ('endpoint', 'outcome'))
+solr_latency = REGISTRY.histogram('sonne_solr_request_seconds', 'solr response time by endpoint kind', ('endpoint',))
+solr_class_active = REGISTRY.gauge('sonne_solr_class_active', 'solr requests in flight per request class',
+                                   ('request_class',))
+solr_class_waiting = REGISTRY.gauge('sonne_solr_class_waiting', 'solr requests waiting for a slot per request class',
+                                    ('request_class',))
+solr_hedged = REGISTRY.counter('sonne_solr_hedged_requests_total', 'requests that were also sent to a second replica')
+solr_replica_up = REGISTRY.gauge('sonne_solr_replica_up', 'whether a solr replica passed its health check',
+                                 ('replica',))
+solr_replica_outstanding = REGISTRY.gauge('sonne_solr_replica_outstanding', 'requests in flight per solr replica',
+                                          ('replica',))
+
+loop_lag = REGISTRY.histogram('sonne_event_loop_lag_seconds', 'how late the event loop ran a periodic callback',
+                              buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+loop_lag_quantile = REGISTRY.gauge('sonne_event_loop_lag_quantile_seconds',
+                                   'event loop lag percentiles over the recent window', ('quantile',))
+loop_stalls = REGISTRY.counter('sonne_event_loop_stalls_total', 'times the event loop was blocked beyond the threshold')
+
+layer_channels = REGISTRY.gauge('sonne_layer_channels', 'open channels in the channel layer')
+layer_queue_depth = REGISTRY.gauge('sonne_layer_queue_depth', 'messages waiting in channel queues', ('stat',))
+layer_congested = REGISTRY.gauge('sonne_layer_congested_channels', 'channels with a full queue')
+layer_publisher_depth = REGISTRY.gauge('sonne_layer_publisher_queue_depth', 'messages waiting to be published')
+layer_dropped = REGISTRY.counter('sonne_layer_dropped_messages_total', 'messages dropped by the channel layer',
+                                ('queue',))
+
+SOLR_ENDPOINTS = {'select', 'get', 'stream', 'export', 'query', 'terms', 'admin'}
+
+
+def solr_endpoint_kind(endpoint: str) -> str:
+    """
+    keep the label cardinality low, the debug passthrough commands can hit any url
+    """
+    kind = endpoint.rstrip('/').rsplit('/', maxsplit=1)[-1]
+    if kind in SOLR_ENDPOINTS:
+        return kind
+    return 'other'
+
+
+def collect_channel_layer():
+    from channels.layers import get_channel_layer
+    layer = get_channel_layer()
+    if layer is None or not hasattr(layer, 'stats'):
+        return
+    stats = layer.stats()
+    layer_channels.set(stats['channels'])
+    layer_queue_depth.set(stats['channel_queue_depth'], stat='total')
+    layer_queue_depth.set(stats['channel_queue_depth_max'], stat='max')
+    layer_congested.set(stats['congested_channels'])
+    layer_publisher_depth.set(stats['publisher_queue_depth'])
+    layer_dropped.advance(stats['dropped_channel_messages'], queue='channel')
+    layer_dropped.advance(stats['dropped_publisher_messages'], queue='publisher')
+
+
+REGISTRY.add_collector(collect_channel_layer)
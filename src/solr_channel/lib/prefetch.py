@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# solr's default page size
+DEFAULT_ROWS = 10
+
+
+def next_page(payload: dict) -> dict:
+    """
+    the JSON request for the page after the one `payload` asks for
+    """
+    params = payload.get('params', {})
+    if 'offset' not in payload and 'limit' not in payload and ('start' in params or 'rows' in params):
+        rows = int(params.get('rows', DEFAULT_ROWS))
+        return {**payload, 'params': {**params, 'start': int(params.get('start', 0)) + rows}}
+    limit = int(payload.get('limit', DEFAULT_ROWS))
+    return {**payload, 'offset': int(payload.get('offset', 0)) + limit}
+
+
+def page_key(collection: str, payload: dict) -> str:
+    return json.dumps([collection, payload], sort_keys=True)
+
+
+def chain_key(collection: str, payload: dict) -> str:
+    """
+    the same for every page of a search
+    """
+    params = {key: value for key, value in payload.get('params', {}).items() if key != 'start'}
+    rest = {key: value for key, value in payload.items() if key not in ('offset', 'params')}
+    return json.dumps([collection, rest, params], sort_keys=True)
+
+
+class Prefetcher:
+    """
+    the speculatively fetched next pages of one connection, at most one per search and `max_entries` in total
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # chain key -> (page key, started, task)
+        self.entries: Dict[str, Tuple[str, float, asyncio.Future]] = {}
+
+    def take(self, collection: str, payload: dict) -> Optional[asyncio.Future]:
+        """
+        the prefetched page for this request, if there is one. a prefetch for another page of the same search
+        is stale and gets cancelled.
+        """
+        self.expire()
+        chain = chain_key(collection, payload)
+        entry = self.entries.pop(chain, None)
+        if entry is None:
+            return None
+        key, _, task = entry
+        if key == page_key(collection, payload):
+            return task
+        task.cancel()
+        return None
+
+    def schedule(self, collection: str, payload: dict, spawn, fetch):
+        """
+        start fetching the page after `payload`
+        :param spawn: starts a task for the connection
+        :param fetch: coroutine function that takes the payload of a page and returns its result
+        """
+        self.expire()
+        chain = chain_key(collection, payload)
+        if chain not in self.entries and self.max_entries <= len(self.entries):
+            oldest = min(self.entries, key=lambda k: self.entries[k][1])
+            self.entries.pop(oldest)[2].cancel()
+        upcoming = next_page(payload)
+        stale = self.entries.pop(chain, None)
+        if stale is not None:
+            stale[2].cancel()
+        task = spawn(fetch(upcoming))
+        # nobody might ever ask for the result, don't complain about an unretrieved exception
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.entries[chain] = (page_key(collection, upcoming), time.monotonic(), task)
+
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        for chain in [chain for chain, (_, started, _) in self.entries.items() if started < deadline]:
+            self.entries.pop(chain)[2].cancel()
+
+    def clear(self):
+        for _, _, task in self.entries.values():
+            task.cancel()
+        self.entries.clear()
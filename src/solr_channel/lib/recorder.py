@@ -0,0 +1,136 @@
+"""
+records sampled JSON-RPC requests, so the production mix of requests can be replayed against a test server
+with benchmarks.replay.
+
+the log has one request per line: {"t": wall clock seconds, "c": connection, "i": request id, "m": method,
+"p": params}. whole connections are sampled instead of single requests, so a replay has the requests that depend
+on each other, i.e. a cursor and its pages. the server side ids in the results, i.e. the cursor a solr_cursor_open
+returned, are written as lines of their own: {"c": connection, "i": request id, "o": {"cursor": id}}. a replay gets
+other ids from its server and maps them with these.
+"""
+import atexit
+import itertools
+import json
+import logging
+import os
+import random
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from solr_channel.lib import metrics
+
+log = logging.getLogger(__name__)
+
+# gets the method and the params of a request and returns the params to record, or None to drop the request.
+# it must not modify the params it is given, the request is handled after it was recorded.
+Sanitizer = Callable[[str, dict], Optional[dict]]
+
+# results that hold these keys created an id the following requests of the connection may use
+ID_KEYS = ('cursor', 'subscription', 'uuid')
+
+GRAPH_METHODS = frozenset(('store_new_graph', 'get_graph', 'update_graph', 'list_graphs'))
+
+
+def drop_graphs(method: str, params: dict) -> Optional[dict]:
+    """
+    graphs are what our users wrote, and the server of a replay does not have them anyway
+    """
+    return None if method in GRAPH_METHODS else params
+
+
+class Recorder:
+    def __init__(self, path: str, sample_rate: float, sanitizers: Iterable[Sanitizer] = (), max_bytes: int = None,
+                 flush_interval: float = 1.0):
+        """
+        :param path: the log file, appended to. `{pid}` is replaced, so several workers can record at once
+        :param sample_rate: the share of connections that are recorded
+        :param max_bytes: recording stops once the log reached this size
+        """
+        self.path = path.format(pid=os.getpid())
+        self.sample_rate = sample_rate
+        self.sanitizers = list(sanitizers)
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.connections = itertools.count(1)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'a', buffering=64 * 1024)
+        self.written = self.file.tell()
+        self.full = False
+        self.flushed = time.monotonic()
+        atexit.register(self.close)
+
+    def connection(self) -> str:
+        """
+        the id the requests of a new connection are recorded under, empty if the connection is not sampled
+        """
+        if self.full or random.random() >= self.sample_rate:
+            return ''
+        return f'{os.getpid()}-{next(self.connections)}'
+
+    def record(self, connection: str, rqid, method: str, params: dict, received: float):
+        if self.full:
+            return
+        try:
+            for sanitize in self.sanitizers:
+                params = sanitize(method, params)
+                if params is None:
+                    metrics.recorded_requests.inc(outcome='dropped')
+                    return
+            line = json.dumps({'t': round(received, 4), 'c': connection, 'i': rqid, 'm': method, 'p': params},
+                              separators=(',', ':')) + '\n'
+        except Exception as e:
+            log.exception(e)
+            metrics.recorded_requests.inc(outcome='failed')
+            return
+        if self._write(line):
+            metrics.recorded_requests.inc(outcome='recorded')
+
+    def record_result(self, connection: str, rqid, result: dict):
+        """
+        write the ids the server created for a request, if its result has any
+        """
+        ids = {key: result[key] for key in ID_KEYS if isinstance(result.get(key), str)}
+        if not ids or self.full:
+            return
+        self._write(json.dumps({'c': connection, 'i': rqid, 'o': ids}, separators=(',', ':')) + '\n')
+
+    def _write(self, line: str) -> bool:
+        if self.max_bytes is not None and self.max_bytes < self.written + len(line):
+            log.warning(f'stopped recording requests, {self.path} reached {self.written} bytes')
+            self.full = True
+            self.file.flush()
+            return False
+        self.file.write(line)
+        self.written += len(line)
+        now = time.monotonic()
+        if self.flush_interval <= now - self.flushed:
+            self.file.flush()
+            self.flushed = now
+        return True
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+_recorder: Optional[Recorder] = None
+
+
+def recorder() -> Optional[Recorder]:
+    """
+    the recorder of this process, configured by settings.RECORDER. None unless its SAMPLE_RATE is above 0.
+    """
+    global _recorder
+    config = getattr(settings, 'RECORDER', None)
+    if not config or not 0 < config.get('SAMPLE_RATE', 0.0):
+        return None
+    if _recorder is None:
+        _recorder = Recorder(config['PATH'], config['SAMPLE_RATE'],
+                             [import_string(path) for path in config.get('SANITIZERS', [])],
+                             config.get('MAX_BYTES', None))
+        log.info(f'recording {config["SAMPLE_RATE"]:.1%} of the connections to {_recorder.path}')
+    return _recorder
@@ -0,0 +1,228 @@
+import fcntl
+import glob
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'SONNESHM'
+VERSION = 1
+# magic, version, slots, data size, write position
+HEADER = struct.Struct('<8sIIQQ')
+HEADER_SIZE = 64
+# key hash, sequence, value length, absolute data position, expiry
+SLOT = struct.Struct('<QIIQd')
+# key length, value length, crc32 of the value
+ENTRY = struct.Struct('<III')
+# slots looked at for a key, starting at hash % slots
+PROBES = 8
+
+
+def key_hash(key: str) -> int:
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+
+class SharedCache:
+    """
+    a byte value cache in a memory mapped file that all worker processes on a host open, so a result fetched by
+    one worker is a hit in all of them.
+
+    the file holds an index of fixed size slots and a ring buffer for the entries. writers append to the ring and
+    take a file lock. readers take no lock: a slot has a sequence number that is odd while it is written, and the
+    reader checks that it did not change, that the ring has not wrapped over the entry and the entry's checksum.
+    eviction is FIFO, old entries are overwritten by the ring, and a full probe sequence drops its oldest slot.
+
+    the layout is part of the file name. a worker started with another size opens a file of its own instead of
+    resizing one that running workers have mapped, they would die of SIGBUS on their next access. files of other
+    layouts are unlinked, a worker that still has one mapped keeps using it until it exits.
+    writers that find the lock taken skip the store instead of stalling their event loop.
+    """
+
+    def __init__(self, path: str, size: int, slots: int, ttl: float):
+        self.path = layout_path(path, size, slots)
+        self.ttl = ttl
+        self.slots = slots
+        self.data_start = HEADER_SIZE + slots * SLOT.size
+        self.data_size = size
+        # an entry larger than this would evict too much at once
+        self.max_entry = size // 8
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        total = self.data_start + size
+        with self._locked():
+            # only a new file is sized, a file that others may have mapped never shrinks
+            if os.fstat(self.fd).st_size < total:
+                os.ftruncate(self.fd, total)
+            self.map = mmap.mmap(self.fd, total)
+            magic, version, existing_slots, existing_size, _ = HEADER.unpack_from(self.map, 0)
+            if (magic, version, existing_slots, existing_size) != (MAGIC, VERSION, slots, size):
+                log.info(f'initializing shared cache {self.path}: {slots} slots, {size} bytes')
+                self.map[:self.data_start] = bytes(self.data_start)
+                HEADER.pack_into(self.map, 0, MAGIC, VERSION, slots, size, 0)
+            self._remove_other_layouts(path)
+
+    def _remove_other_layouts(self, path: str):
+        for other in glob.glob(glob.escape(path) + '.v*'):
+            if other != self.path:
+                log.info(f'removing shared cache {other} of another layout')
+                try:
+                    os.unlink(other)
+                except FileNotFoundError:
+                    pass
+
+    @contextmanager
+    def _locked(self, blocking=True):
+        """
+        raises BlockingIOError if the lock is taken and `blocking` is False
+        """
+        fcntl.flock(self.fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @property
+    def write_pos(self) -> int:
+        return HEADER.unpack_from(self.map, 0)[4]
+
+    def _slot_offset(self, index: int) -> int:
+        return HEADER_SIZE + index * SLOT.size
+
+    def _probe(self, h: int):
+        start = h % self.slots
+        for n in range(PROBES):
+            yield (start + n) % self.slots
+
+    def _intact(self, position: int, length: int) -> bool:
+        # the ring has not been written over the entry since it was stored
+        return self.write_pos - position <= self.data_size - length
+
+    def get(self, key: str, now: float = None) -> Optional[bytes]:
+        h = key_hash(key)
+        now = time.time() if now is None else now
+        for index in self._probe(h):
+            offset = self._slot_offset(index)
+            slot_hash, seq, length, position, expires = SLOT.unpack_from(self.map, offset)
+            if slot_hash != h or seq % 2:
+                continue
+            if expires < now or not self._intact(position, length):
+                return None
+            start = self.data_start + position % self.data_size
+            key_length, value_length, crc = ENTRY.unpack_from(self.map, start)
+            if ENTRY.size + key_length + value_length != length:
+                return None
+            if self.map[start + ENTRY.size:start + ENTRY.size + key_length] != key.encode():
+                continue
+            value_start = start + ENTRY.size + key_length
+            value = self.map[value_start:value_start + value_length]
+            # nothing changed while we copied
+            if SLOT.unpack_from(self.map, offset)[1] != seq or not self._intact(position, length):
+                return None
+            if zlib.crc32(value) != crc:
+                return None
+            return value
+        return None
+
+    def set(self, key: str, value: bytes, ttl: float = None) -> bool:
+        """
+        :return: whether the value was stored, it is not if it is too large or another writer holds the lock
+        """
+        encoded_key = key.encode()
+        length = ENTRY.size + len(encoded_key) + len(value)
+        if self.max_entry < length:
+            return False
+        h = key_hash(key)
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        try:
+            with self._locked(blocking=False):
+                self._store(h, encoded_key, value, length, expires)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _store(self, h: int, encoded_key: bytes, value: bytes, length: int, expires: float):
+        index = self._pick_slot(h)
+        offset = self._slot_offset(index)
+        seq = SLOT.unpack_from(self.map, offset)[1]
+        # wraps around, but stays odd while the slot is written
+        SLOT.pack_into(self.map, offset, h, (seq + 1) & 0xffffffff, 0, 0, 0.0)
+
+        position = self.write_pos
+        if self.data_size < position % self.data_size + length:
+            # entries are contiguous, start over at the beginning of the ring
+            position += self.data_size - position % self.data_size
+        # move the write position first, readers of the entries we overwrite see that they are gone
+        header = list(HEADER.unpack_from(self.map, 0))
+        header[4] = position + length
+        HEADER.pack_into(self.map, 0, *header)
+        start = self.data_start + position % self.data_size
+        self.map[start:start + length] = ENTRY.pack(len(encoded_key), len(value), zlib.crc32(value)) \
+            + encoded_key + value
+
+        SLOT.pack_into(self.map, offset, h, (seq + 2) & 0xffffffff, length, position, expires)
+
+    def _pick_slot(self, h: int) -> int:
+        """
+        the slot of the key, an unused one, or the one with the oldest entry
+        """
+        now = time.time()
+        oldest, oldest_position = None, None
+        for index in self._probe(h):
+            slot_hash, _, length, position, expires = SLOT.unpack_from(self.map, self._slot_offset(index))
+            if slot_hash == h or slot_hash == 0 or expires < now or not self._intact(position, length):
+                return index
+            if oldest_position is None or position < oldest_position:
+                oldest, oldest_position = index, position
+        return oldest
+
+    def clear(self):
+        with self._locked():
+            self.map[HEADER_SIZE:self.data_start] = bytes(self.data_start - HEADER_SIZE)
+
+    def stats(self) -> dict:
+        now = time.time()
+        used = 0
+        live_bytes = 0
+        for index in range(self.slots):
+            slot_hash, _, length, position, expires = SLOT.unpack_from(self.map, self._slot_offset(index))
+            if slot_hash and now <= expires and self._intact(position, length):
+                used += 1
+                live_bytes += length
+        return {'slots': self.slots, 'used_slots': used, 'data_size': self.data_size, 'live_bytes': live_bytes,
+                'written_bytes': self.write_pos}
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def layout_path(path: str, size: int, slots: int) -> str:
+    return f'{path}.v{VERSION}-{slots}x{size}'
+
+
+_shared_cache: Optional[SharedCache] = None
+
+
+def shared_cache() -> Optional[SharedCache]:
+    """
+    the result cache shared by the workers of this host, configured by settings.SHARED_CACHE. None unless its TTL
+    is above 0.
+    """
+    global _shared_cache
+    config = getattr(settings, 'SHARED_CACHE', None)
+    if not config or not 0 < config.get('TTL', 0):
+        return None
+    if _shared_cache is None:
+        _shared_cache = SharedCache(config['PATH'], config['SIZE'], config['SLOTS'], config['TTL'])
+    return _shared_cache
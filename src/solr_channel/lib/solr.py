@@ -0,0 +1,223 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+from typing import List, Optional, Union
+
+from django.conf import settings
+
+from solr_channel.lib import metrics
+from solr_channel.lib.admission import ConcurrencyLimiter, PriorityLimiter, solr_limiter
+from solr_channel.lib.jsoncodec import json_codec
+
+log = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _aiohttp():
+    # aiohttp takes a while to import, only pay for it once the first request is made
+    import aiohttp
+    return aiohttp
+
+
+class Replica:
+    def __init__(self, base: str):
+        self.base = base.rstrip('/')
+        self.outstanding = 0
+        self.healthy = True
+        self.last_error = ''
+
+    def eject(self, reason: str):
+        if self.healthy:
+            log.warning(f'ejecting solr replica {self.base}: {reason}')
+        self.healthy = False
+        self.last_error = reason
+
+    def restore(self):
+        if not self.healthy:
+            log.warning(f'solr replica {self.base} is healthy again')
+        self.healthy = True
+        self.last_error = ''
+
+    def __repr__(self):
+        return f'Replica({self.base}, outstanding={self.outstanding}, healthy={self.healthy})'
+
+
+class SolrClient:
+    """
+    sends requests to one of several solr replicas.
+
+    requests go to the healthy replica with the fewest outstanding requests, a replica is ejected when a request
+    to it fails to connect and restored by the background health check. read-only requests can be hedged:
+    if the first replica did not answer after `hedge_after` seconds, the request is sent to a second replica
+    as well and the first answer wins.
+    """
+
+    def __init__(self, hosts: List[str], health_path='/solr/admin/info/system', health_interval=5.0,
+                 hedge_after: Optional[float] = None, timeout=60.0,
+                 limiter: Union[ConcurrencyLimiter, PriorityLimiter] = None):
+        if not hosts:
+            raise ValueError('at least one solr host is needed')
+        self.replicas = [Replica(host) for host in hosts]
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.hedge_after = hedge_after
+        self.timeout = timeout
+        self.limiter = limiter
+        self.session = None
+        self.health_task: Optional[asyncio.Task] = None
+
+    def _ensure_started(self):
+        if self.session is None or self.session.closed:
+            aiohttp = _aiohttp()
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        if 1 < len(self.replicas) and (self.health_task is None or self.health_task.done()):
+            self.health_task = asyncio.ensure_future(self._health_loop())
+
+    def pick(self, exclude=()) -> Optional[Replica]:
+        candidates = [r for r in self.replicas if r.healthy and r not in exclude]
+        if not candidates:
+            # better a replica that might be down than no answer at all
+            candidates = [r for r in self.replicas if r not in exclude]
+        if not candidates:
+            return None
+        least = min(r.outstanding for r in candidates)
+        return random.choice([r for r in candidates if r.outstanding == least])
+
+    async def request(self, path: str, method: str = 'GET', json=None, params=None, hedge=False,
+                      raw=False) -> Union[dict, bytes]:
+        """
+        :param path: the path below the solr host, i.e. /api/c/collection/select
+        :param hedge: only for idempotent requests, allows sending the request to a second replica
+        :param raw: return the body as it came from solr, without decoding it
+        :return: the decoded JSON response
+        """
+        self._ensure_started()
+        first = self.pick()
+        if not hedge or self.hedge_after is None or 2 > len(self.replicas):
+            return await self._send(first, path, method, json, params, raw)
+
+        primary = asyncio.ensure_future(self._send(first, path, method, json, params, raw))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_after)
+            if done:
+                return primary.result()
+            second = self.pick(exclude=(first,))
+            if second is None:
+                return await primary
+            log.info(f'hedging {path}: {first.base} did not answer within {self.hedge_after}s, asking {second.base}')
+            metrics.solr_hedged.inc()
+            backup = asyncio.ensure_future(self._send(second, path, method, json, params, raw))
+            tasks.append(backup)
+            pending = {primary, backup}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # also when the caller is cancelled, i.e. by a deadline, so no request keeps its limiter slot
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _send(self, replica: Replica, path: str, method: str, json, params, raw=False) -> Union[dict, bytes]:
+        if self.limiter is None:
+            return await self._send_unlimited(replica, path, method, json, params, raw)
+        async with self.limiter:
+            return await self._send_unlimited(replica, path, method, json, params, raw)
+
+    async def _send_unlimited(self, replica: Replica, path: str, method: str, json, params,
+                              raw=False) -> Union[dict, bytes]:
+        replica.outstanding += 1
+        try:
+            async with self.session.request(method, replica.base + path, json=json, params=params) as response:
+                log.info(response.request_info)
+                if raw:
+                    return await response.read()
+                # large results are decoded off the event loop, see channels_zeromq.codec
+                return await json_codec().loads(await response.text())
+        except _aiohttp().ClientConnectionError as e:
+            replica.eject(str(e))
+            raise
+        finally:
+            replica.outstanding -= 1
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*[self._check(replica) for replica in self.replicas])
+            await asyncio.sleep(self.health_interval)
+
+    async def _check(self, replica: Replica):
+        aiohttp = _aiohttp()
+        start = time.perf_counter()
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.health_interval)
+            async with self.session.get(replica.base + self.health_path, params={'wt': 'json'},
+                                        timeout=timeout) as response:
+                if 200 != response.status:
+                    replica.eject(f'health check returned {response.status}')
+                    return
+            replica.restore()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            replica.eject(f'health check failed after {time.perf_counter() - start:.1f}s: {e!r}')
+
+    def collect_metrics(self):
+        for replica in self.replicas:
+            metrics.solr_replica_up.set(int(replica.healthy), replica=replica.base)
+            metrics.solr_replica_outstanding.set(replica.outstanding, replica=replica.base)
+
+    async def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+
+# bodies up to this size are decoded to look for an error, larger ones only have their beginning searched
+SNIFF_LIMIT = 64 * 1024
+SNIFF_HEAD = 4096
+
+
+async def sniff_error(body: bytes) -> Optional[dict]:
+    """
+    the error of a raw solr response, if there is one. solr puts it at the top level next to a short
+    responseHeader and error responses are small, so a large body only needs its beginning searched.
+    the body is spliced into the response as it is, so one that does not end like a JSON object is decoded
+    to be sure it is complete. raises JSONDecodeError if the body is not JSON at all.
+    """
+    head = body[:SNIFF_HEAD]
+    if (SNIFF_LIMIT < len(body) and head.lstrip()[:1] == b'{' and body.rstrip()[-1:] == b'}'
+            and b'"error"' not in head):
+        return None
+    decoded = await json_codec().loads(body.decode())
+    if isinstance(decoded, dict):
+        return decoded.get('error', None)
+    return None
+
+
+_client: Optional[SolrClient] = None
+
+
+def get_client() -> SolrClient:
+    """
+    the client shared by all consumers of this process, configured by settings.SOLR_HOSTS and settings.SOLR_CLIENT
+    """
+    global _client
+    if _client is None:
+        config = getattr(settings, 'SOLR_CLIENT', {})
+        _client = SolrClient(
+            getattr(settings, 'SOLR_HOSTS', [settings.SOLR_HOST]),
+            health_path=config.get('HEALTH_PATH', '/solr/admin/info/system'),
+            health_interval=config.get('HEALTH_INTERVAL', 5.0),
+            hedge_after=config.get('HEDGE_AFTER', None),
+            timeout=config.get('TIMEOUT', 60.0),
+            limiter=solr_limiter(),
+        )
+        metrics.REGISTRY.add_collector(_client.collect_metrics)
+    return _client
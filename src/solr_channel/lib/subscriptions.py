@@ -0,0 +1,155 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from django.conf import settings
+
+from solr_channel.lib import metrics
+from solr_channel.lib.jsoncodec import json_codec
+
+log = logging.getLogger(__name__)
+
+# the message type of the updates, channels dispatches it to the consumer's query_update
+UPDATE_TYPE = 'query.update'
+# parts of a result that change on every request without the result changing
+VOLATILE_KEYS = ('responseHeader',)
+
+
+def subscription_key(collection: str, payload: dict) -> str:
+    canonical = json.dumps([collection, payload], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode()).hexdigest()[:24]
+
+
+async def result_digest(result: Any) -> str:
+    if isinstance(result, dict):
+        result = {key: value for key, value in result.items() if key not in VOLATILE_KEYS}
+    # solr answers the same query with the same key order, no need to sort
+    return hashlib.sha1((await json_codec().dumps(result)).encode()).hexdigest()
+
+
+class QueryPoller:
+    """
+    polls one query for all of its subscribers and broadcasts the result to their group when it changed
+    """
+
+    def __init__(self, key: str, fetch: Callable[[], Awaitable[Any]], layer, interval: float):
+        self.key = key
+        self.group = f'query.{key}'
+        self.fetch = fetch
+        self.layer = layer
+        self.interval = interval
+        self.subscribers: Set[str] = set()
+        self.version = 0
+        self.result = None
+        self.error: Optional[str] = None
+        self.digest = None
+        self.polled = asyncio.Event()
+        self.task: Optional[asyncio.Future] = None
+
+    def start(self):
+        # the first subscriber's request starts the poller, it must not inherit that request's trace or solr class
+        self.task = contextvars.Context().run(asyncio.ensure_future, self._poll())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def current(self) -> dict:
+        """
+        the latest result, waits for the first poll
+        """
+        await self.polled.wait()
+        if self.result is None and self.error is not None:
+            return {'subscription': self.key, 'version': self.version, 'error': self.error}
+        return {'subscription': self.key, 'version': self.version, 'result': self.result}
+
+    async def _poll(self):
+        while True:
+            try:
+                result = await self.fetch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.query_polls.inc(outcome='failed')
+                log.warning(f'polling {self.group} failed: {e!r}')
+                if self.error is None:
+                    self.error = str(e)
+                    self.digest = None
+                    await self.broadcast({'error': self.error})
+            else:
+                digest = await result_digest(result)
+                if digest == self.digest:
+                    metrics.query_polls.inc(outcome='unchanged')
+                else:
+                    metrics.query_polls.inc(outcome='changed')
+                    self.digest = digest
+                    self.result = result
+                    self.error = None
+                    self.version += 1
+                    await self.broadcast({'result': result})
+            self.polled.set()
+            await asyncio.sleep(self.interval)
+
+    async def broadcast(self, content: dict):
+        if not self.polled.is_set():
+            # nobody has seen a result yet, the subscribers get the first one as their response
+            return
+        await self.layer.group_send(self.group, {
+            'type': UPDATE_TYPE,
+            'subscription': self.key,
+            'version': self.version,
+            **content,
+        })
+
+
+class PollerRegistry:
+    """
+    the pollers of this process, one per distinct query no matter how many connections subscribed to it
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.pollers: Dict[str, QueryPoller] = {}
+
+    def subscribe(self, key: str, channel: str, fetch: Callable[[], Awaitable[Any]], layer) -> QueryPoller:
+        poller = self.pollers.get(key)
+        if poller is None:
+            poller = self.pollers[key] = QueryPoller(key, fetch, layer, self.interval)
+            poller.start()
+            log.info(f'started poller {poller.group}')
+        poller.subscribers.add(channel)
+        return poller
+
+    def unsubscribe(self, key: str, channel: str) -> Optional[QueryPoller]:
+        poller = self.pollers.get(key)
+        if poller is None or channel not in poller.subscribers:
+            return None
+        poller.subscribers.discard(channel)
+        if not poller.subscribers:
+            poller.stop()
+            del self.pollers[key]
+            log.info(f'stopped poller {poller.group}, no subscribers left')
+        return poller
+
+    def collect_metrics(self):
+        # a copy, the loop starts and stops pollers while the metrics view renders in another thread
+        polling = list(self.pollers.values())
+        metrics.query_pollers.set(len(polling))
+        metrics.query_subscribers.set(sum(len(poller.subscribers) for poller in polling))
+
+
+_registry: Optional[PollerRegistry] = None
+
+
+def pollers() -> PollerRegistry:
+    """
+    the registry of this process, polling every settings.SUBSCRIPTIONS['INTERVAL'] seconds
+    """
+    global _registry
+    if _registry is None:
+        _registry = PollerRegistry(settings.SUBSCRIPTIONS['INTERVAL'])
+        metrics.REGISTRY.add_collector(_registry.collect_metrics)
+    return _registry
@@ -0,0 +1,171 @@
+import contextvars
+import json
+import logging
+import random
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional, List
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+log = logging.getLogger(__name__)
+
+# the key the trace travels under in channel layer messages, it is removed before the command sees the event
+MESSAGE_KEY = '_trace'
+
+_current: contextvars.ContextVar = contextvars.ContextVar('trace', default=None)
+
+
+class Span:
+    __slots__ = ('name', 'start', 'duration', 'attrs')
+
+    def __init__(self, name: str, start: float, duration: float, attrs: dict = None):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.attrs = attrs or {}
+
+    def as_dict(self) -> dict:
+        return {'name': self.name, 'start': self.start, 'duration': self.duration, **self.attrs}
+
+
+class Trace:
+    """
+    the spans of one JSON-RPC request in one stage, i.e. before or after the channel layer hop.
+    both parts share the trace id and are exported separately.
+    """
+
+    def __init__(self, rqid, method: str, trace_id: str = None):
+        self.rqid = rqid
+        self.method = method
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.spans: List[Span] = []
+
+    def add(self, name: str, start: float, end: float = None, **attrs):
+        """
+        add a span that already happened, times are wall clock seconds
+        """
+        if end is None:
+            end = time.time()
+        self.spans.append(Span(name, start, end - start, attrs))
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, **attrs)
+
+    def header(self) -> dict:
+        return {'id': self.trace_id, 'rqid': self.rqid, 'method': self.method, 'sent': time.time()}
+
+    @classmethod
+    def from_header(cls, header: dict) -> 'Trace':
+        trace = cls(header['rqid'], header['method'], header['id'])
+        trace.add('channel_layer', header['sent'])
+        return trace
+
+    def as_dict(self) -> dict:
+        return {
+            'trace': self.trace_id,
+            'rqid': self.rqid,
+            'method': self.method,
+            'spans': [span.as_dict() for span in self.spans],
+        }
+
+
+class LogExporter:
+    """
+    append every trace as a JSON line to a file
+    """
+
+    def __init__(self, path='traces.jsonl'):
+        self.path = path
+        self.file = open(path, 'a', buffering=1)
+
+    def export(self, trace: Trace):
+        self.file.write(json.dumps(trace.as_dict()) + '\n')
+
+
+class CollectorExporter:
+    """
+    send every trace as a JSON datagram to a collector on this host, fire and forget
+    """
+
+    def __init__(self, host='127.0.0.1', port=6831):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def export(self, trace: Trace):
+        try:
+            self.socket.sendto(json.dumps(trace.as_dict()).encode(), self.address)
+        except OSError as e:
+            log.debug(f'could not send trace: {e}')
+
+
+class Tracer:
+    def __init__(self, sample_rate: float = 0.0, exporter=None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+
+    def start(self, rqid, method: str) -> Optional[Trace]:
+        if self.exporter is None or random.random() >= self.sample_rate:
+            return None
+        return Trace(rqid, method)
+
+    def finish(self, trace: Optional[Trace]):
+        if trace is None or not trace.spans:
+            return
+        try:
+            self.exporter.export(trace)
+        except Exception as e:
+            log.exception(e)
+
+
+_tracer: Optional[Tracer] = None
+
+
+def get_tracer() -> Tracer:
+    """
+    configured by settings.TRACING: SAMPLE_RATE (0..1), EXPORTER (dotted path) and OPTIONS for the exporter
+    """
+    global _tracer
+    if _tracer is None:
+        config = getattr(settings, 'TRACING', {})
+        rate = config.get('SAMPLE_RATE', 0.0)
+        exporter = None
+        if 0 < rate:
+            exporter = import_string(config.get('EXPORTER', 'solr_channel.lib.tracing.LogExporter'))(
+                **config.get('OPTIONS', {}))
+        _tracer = Tracer(rate, exporter)
+    return _tracer
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+def activate(trace: Optional[Trace]):
+    return _current.set(trace)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    record a span on the active trace, if the current request is sampled
+    """
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name, **attrs):
+        yield
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from solr_channel.lib import expiry
+
+
+class Command(BaseCommand):
+    help = 'delete graphs that were neither modified nor read for a while and give the space back to the filesystem'
+
+    def add_arguments(self, parser):
+        config = settings.GRAPH_EXPIRY
+        parser.add_argument('--max-age', type=float, default=config['MAX_AGE'] / 86400,
+                            help='delete graphs neither modified nor read for this many days')
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'],
+                            help='rows deleted per transaction')
+        parser.add_argument('--pause', type=float, default=config['BATCH_PAUSE'],
+                            help='seconds to wait between batches')
+        parser.add_argument('--vacuum-pages', type=int, default=config['VACUUM_PAGES'],
+                            help='pages to free after deleting, 0 frees all of them')
+        parser.add_argument('--no-vacuum', action='store_true', help='keep the free pages in the file')
+        parser.add_argument('--dry-run', action='store_true', help='only count the graphs that would be deleted')
+        parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                            help='switch the database to auto_vacuum=INCREMENTAL first, rewrites the whole file once')
+
+    def handle(self, *args, **options):
+        if options['max_age'] <= 0 or options['batch_size'] <= 0:
+            raise CommandError('--max-age and --batch-size must be positive')
+        if options['enable_incremental_vacuum']:
+            self.stdout.write('rewriting the database with auto_vacuum=INCREMENTAL')
+            expiry.enable_incremental_vacuum()
+        stats = expiry.expire_graphs(options['max_age'] * 86400, options['batch_size'], options['pause'],
+                                     vacuum=not options['no_vacuum'], vacuum_pages=options['vacuum_pages'],
+                                     dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write(f'{stats.deleted} graphs would be deleted')
+            return
+        self.stdout.write(f'deleted {stats.deleted} graphs in {stats.batches} batches, {stats.seconds:.2f}s')
+        self.stdout.write(f'database {stats.bytes_before} -> {stats.bytes_after} bytes, '
+                          f'reclaimed {stats.reclaimed}, {stats.free_pages} free pages left')
+        if stats.deleted and not stats.vacuumed and not options['no_vacuum']:
+            self.stdout.write('the database does not use incremental vacuum, the free pages are reused by new graphs. '
+                              'run once with --enable-incremental-vacuum to give them back to the filesystem.')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from solr_channel.models import Graph
+
+
+class Command(BaseCommand):
+    help = 'list stored graphs, newest first, one page at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=50, help='graphs per page')
+        parser.add_argument('--after', default=None, help='the position printed after the previous page')
+        parser.add_argument('--all', action='store_true', help='keep going until the last page')
+
+    def handle(self, *args, **options):
+        if options['limit'] < 1:
+            raise CommandError('--limit must be at least 1')
+        after = options['after']
+        while True:
+            try:
+                graphs, after = Graph.objects.page(after, options['limit'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            for graph in graphs:
+                self.stdout.write(f'{graph.id}  {graph.ctime.isoformat()}  {graph.mtime.isoformat()}')
+            if after is None or not options['all']:
+                break
+        if after is not None:
+            self.stdout.write(f'next page: --after {after}')
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+# runs in a fresh interpreter, so nothing is imported yet. prints the phases of a daphne worker's startup.
+PROBE = '''
+import os, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sonne.settings')
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+import sonne.routing
+routing = time.perf_counter()
+from solr_channel.consumers import JsonRpcHandlerBase
+for registry in (JsonRpcHandlerBase.commands, JsonRpcHandlerBase.chn_commands):
+    for commands in registry.values():
+        JsonRpcHandlerBase.describe(commands)
+schemas = time.perf_counter()
+print(f'PHASE django.setup {setup - start}')
+print(f'PHASE routing {routing - setup}')
+print(f'PHASE schemas {schemas - routing}')
+print(f'PHASE total {schemas - start}')
+'''
+
+
+class Command(BaseCommand):
+    help = 'measure how long a worker takes to start and which imports are the most expensive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='number of imports to list')
+        parser.add_argument('--runs', type=int, default=3, help='startups to measure, the fastest is reported')
+
+    def probe(self):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='sonne.settings')
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE], env=env,
+                                   capture_output=True, text=True)
+        if 0 != completed.returncode:
+            raise CommandError(completed.stderr)
+        phases = {}
+        for line in completed.stdout.splitlines():
+            if line.startswith('PHASE '):
+                _, name, seconds = line.split()
+                phases[name] = float(seconds)
+        imports = []
+        for line in completed.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            own, cumulative, name = line[len('import time:'):].split('|')
+            # nested imports are indented by two more spaces per level
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            imports.append((int(cumulative), int(own), depth, name.strip()))
+        return phases, imports
+
+    def handle(self, *args, **options):
+        runs = [self.probe() for _ in range(options['runs'])]
+        phases, imports = min(runs, key=lambda run: run[0]['total'])
+        self.stdout.write('startup phases (fastest of %d runs):' % options['runs'])
+        for name, seconds in phases.items():
+            self.stdout.write(f'  {name:15s} {seconds * 1000:8.1f} ms')
+        self.stdout.write(f'\nslowest imports (cumulative, self):')
+        top_level = [(cumulative, own, name) for cumulative, own, depth, name in imports if 0 == depth]
+        for cumulative, own, name in sorted(top_level, reverse=True)[:options['top']]:
+            self.stdout.write(f'  {cumulative / 1000:8.1f} ms {own / 1000:8.1f} ms  {name}')
@@ -0,0 +1,21 @@
+# Generated by Django 2.2 on 2026-10-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('solr_channel', '0001_squashed_0002_auto_20190406_0928'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='graph',
+            index=models.Index(fields=['ctime'], name='graph_ctime_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='graph',
+            index=models.Index(fields=['mtime', 'id'], name='graph_mtime_id_idx'),
+        ),
+    ]
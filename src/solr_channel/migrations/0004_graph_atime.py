@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-19 14:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('solr_channel', '0003_graph_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='graph',
+            name='atime',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='access time'),
+        ),
+    ]
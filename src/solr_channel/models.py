@@ -1,9 +1,73 @@
+import base64
+import binascii
+from datetime import timedelta
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 import uuid
 
+# the access time is written at most once per this interval, so reading a graph rarely writes
+ATIME_RESOLUTION = timedelta(days=1)
+
+
+def encode_position(graph) -> str:
+    return base64.urlsafe_b64encode(f'{graph.mtime.isoformat()}|{graph.id}'.encode()).decode()
+
+
+def decode_position(position: str):
+    try:
+        mtime, graph_id = base64.urlsafe_b64decode(position.encode()).decode().split('|')
+        mtime = parse_datetime(mtime)
+        graph_id = uuid.UUID(graph_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f'invalid position: {position}') from e
+    if mtime is None:
+        raise ValueError(f'invalid position: {position}')
+    return mtime, graph_id
+
+
+class GraphQuerySet(models.QuerySet):
+    def page(self, after: str = None, limit: int = 50):
+        """
+        graphs by modification time, newest first. seeks past the position instead of counting an OFFSET,
+        so every page costs the same, no matter how deep it is.
+        :param after: the position returned with the previous page
+        :return: the graphs and the position of the next page, None on the last page
+        """
+        graphs = self.only('id', 'ctime', 'mtime').order_by('-mtime', '-id')
+        if after:
+            mtime, graph_id = decode_position(after)
+            graphs = graphs.filter(Q(mtime__lt=mtime) | Q(mtime=mtime, id__lt=graph_id))
+        rows = list(graphs[:limit + 1])
+        if limit < len(rows):
+            return rows[:limit], encode_position(rows[limit - 1])
+        return rows, None
+
 
 class Graph(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     graph_str = models.TextField()
     ctime = models.DateTimeField('creation time')
     mtime = models.DateTimeField('modification time')
+    # null until the graph is read for the first time
+    atime = models.DateTimeField('access time', null=True, blank=True)
+
+    objects = GraphQuerySet.as_manager()
+
+    def touch(self):
+        """
+        record that the graph was read, unless that was already done within ATIME_RESOLUTION
+        """
+        now = timezone.now()
+        if self.atime is None or self.atime < now - ATIME_RESOLUTION:
+            self.atime = now
+            # only the one column, a concurrent update_graph keeps its data and mtime
+            Graph.objects.filter(id=self.id).update(atime=now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ctime'], name='graph_ctime_idx'),
+            # the order of the keyset pagination
+            models.Index(fields=['mtime', 'id'], name='graph_mtime_id_idx'),
+        ]
@@ -1 +1,21 @@
-# Create your views here.
+from django.http import HttpResponse, JsonResponse
+
+from solr_channel.lib import metrics as m
+from solr_channel.lib.looplag import loop_monitor
+
+
+def metrics(request):
+    """
+    prometheus text exposition of the counters of this process
+    """
+    return HttpResponse(m.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def loop_lag(request):
+    """
+    event loop lag percentiles and the stacks of recent stalls
+    """
+    monitor = loop_monitor()
+    if monitor is None:
+        return JsonResponse({'error': 'the loop monitor is disabled'}, status=404)
+    return JsonResponse(monitor.stats())
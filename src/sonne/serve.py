@@ -0,0 +1,37 @@
+"""
+starts daphne with the event loop chosen by settings.EVENT_LOOP, takes the same arguments as daphne:
+
+    python -m sonne.serve -u /tmp/sonne_daphne.sock sonne.asgi:application
+
+daphne creates its loop when daphne.server is imported, so the loop policy has to be installed before that.
+"""
+import asyncio
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+LOOPS = ('asyncio', 'uvloop')
+
+
+def install_loop_policy(name: str):
+    if name not in LOOPS:
+        raise ValueError(f'unsupported event loop: {name}, must be one of {list(LOOPS)}')
+    if name == 'uvloop':
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sonne.settings')
+    # only reads the settings module, which imports neither django.setup nor daphne
+    from django.conf import settings
+    install_loop_policy(settings.EVENT_LOOP)
+    from daphne.cli import CommandLineInterface
+    CommandLineInterface.entrypoint()
+
+
+if __name__ == '__main__':
+    main()
@@ -34,7 +34,8 @@
 else:
     print('running in DEBUG mode', sys.stderr)
     DEBUG = True
-    SOLR_HOST = 'http://localhost:8983'
+    # the load tests point this at benchmarks.fake_solr
+    SOLR_HOST = os.environ.get('SONNE_SOLR_HOST', 'http://localhost:8983')
     SECRET_KEY = '$39&prvnp-+)docy$k&ue425%g5e$6$@sv!*_@prtg-^$8v8*i'
     ALLOWED_HOSTS = []
 
@@ -104,10 +105,148 @@
         'BACKEND': 'channels_zeromq.core.ZeroMqGroupLayer',
         'CONFIG': {
             "channel_capacity": 1000,
+            # what to do when a consumer can't keep up, see channels_zeromq.flow.Overflow
+            "overflow": "drop_oldest",
+            "overflow_timeout": 1.0,
+            "publisher_overflow": "drop_newest",
+            # messages are encoded/decoded in a worker thread from JSON_OFFLOAD['THRESHOLD'] characters on
         },
     },
 }
 
+# every replica of the solr cluster we may send requests to, see solr_channel.lib.solr
+SOLR_HOSTS = [SOLR_HOST]
+SOLR_CLIENT = {
+    'HEALTH_PATH': '/solr/admin/info/system',
+    'HEALTH_INTERVAL': 5.0,
+    # send slow solr_get and solr_select requests to a second replica after this many seconds, None to disable
+    'HEDGE_AFTER': 0.25,
+    'TIMEOUT': 60.0,
+}
+
+# admission control, see solr_channel.lib.admission
+ADMISSION = {
+    'MAX_CONNECTIONS': 5000,
+    # solr requests in flight, more may wait up to SOLR_QUEUE_TIMEOUT seconds, beyond MAX_SOLR_QUEUE they are rejected
+    'MAX_SOLR_CONCURRENCY': 64,
+    'MAX_SOLR_QUEUE': 256,
+    'SOLR_QUEUE_TIMEOUT': 5.0,
+    # the slots are shared by the cost classes of the commands: (weight, share). while several classes wait,
+    # they get slots in proportion to their weight, and no class holds more than its share of the slots at once.
+    'SOLR_CLASSES': {
+        'cheap': (8, 1.0),
+        'normal': (4, 0.9),
+        'expensive': (1, 0.25),
+    },
+    # token buckets per connection and cost class: (requests per second, burst)
+    'RATE_LIMITS': {
+        'cheap': (20.0, 50),
+        'normal': (5.0, 20),
+        'expensive': (0.5, 3),
+    },
+}
+
+# server side cursors for deep paging, TTL in seconds since the last page was fetched,
+# MAX_ROWS is the largest page a cursor may ask solr for
+CURSORS = {
+    'TTL': 300,
+    'MAX_PER_CONNECTION': 10,
+    'MAX_ROWS': 1000,
+}
+
+# speculative prefetch of the next solr_select page, TTL in seconds until an unused page is dropped
+PREFETCH = {
+    'TTL': 60,
+    'MAX_PER_CONNECTION': 2,
+}
+
+# defaults for clients that call set_compression: responses above THRESHOLD bytes become compressed binary frames
+COMPRESSION = {
+    'THRESHOLD': 16384,
+    'LEVELS': {'deflate': 6, 'zstd': 3},
+}
+
+# author analytics survive restarts in this cache, set it to None to disable it
+ANALYTICS_CACHE = {
+    'PATH': os.path.join(BASE_DIR, 'data', 'analytics-cache.sqlite3'),
+    'TTL': 7 * 24 * 3600,
+    'MAX_BYTES': 256 * 1024 * 1024,
+}
+
+# subscribe_query: every distinct query is polled once per INTERVAL seconds, no matter how many connections subscribed
+SUBSCRIPTIONS = {
+    'INTERVAL': 5.0,
+    'MAX_PER_CONNECTION': 10,
+}
+
+# graphs that were neither modified nor read for MAX_AGE seconds are deleted by `manage.py expire_graphs`,
+# and every INTERVAL seconds in each worker if INTERVAL is set. VACUUM_PAGES = 0 frees all pages.
+GRAPH_EXPIRY = {
+    'MAX_AGE': 365 * 24 * 3600,
+    'BATCH_SIZE': 500,
+    'BATCH_PAUSE': 0.05,
+    'VACUUM_PAGES': 0,
+    'INTERVAL': None,
+}
+
+# measures the event loop's scheduling delay and samples the stack when it is blocked longer than THRESHOLD,
+# see /metrics/loop. set it to None to disable it.
+LOOP_MONITOR = {
+    'INTERVAL': 0.05,
+    'THRESHOLD': 0.1,
+    'WINDOW': 1200,
+    'MAX_STALLS': 20,
+}
+
+# the event loop implementation when started with `python -m sonne.serve`, 'asyncio' or 'uvloop'
+EVENT_LOOP = os.environ.get('SONNE_EVENT_LOOP', 'asyncio')
+
+# websocket frames, solr responses and channel layer messages of at least THRESHOLD characters are encoded and
+# decoded in a worker thread, see channels_zeromq.codec. None keeps everything on the event loop.
+JSON_OFFLOAD = {
+    'THRESHOLD': 256 * 1024,
+}
+
+# solr results shared by all workers on this host in a memory mapped file, see solr_channel.lib.shmcache.
+# SIZE bytes for the entries, SLOTS entries at most, TTL in seconds. results are up to TTL seconds stale,
+# so the cache is off unless TTL is above 0, i.e. SONNE_SHARED_CACHE_TTL=5.
+# the layout is appended to PATH, workers with different sizes use different files.
+SHARED_CACHE = {
+    'PATH': '/dev/shm/sonne-results' if os.path.isdir('/dev/shm') else os.path.join(BASE_DIR, 'data', 'results.shm'),
+    'SIZE': 64 * 1024 * 1024,
+    'SLOTS': 16384,
+    'TTL': float(os.environ.get('SONNE_SHARED_CACHE_TTL', 0.0)),
+}
+
+# suggest_author answers from an index of the author names in memory, built from a facet on FIELD of at most
+# MAX_AUTHORS authors per collection. COLLECTIONS are indexed when a worker starts, others when they are first asked
+# for, and all of them are rebuilt every REFRESH seconds. prefixes matching more than SCAN_LIMIT names have their
+# TOP_K authors computed when the index is built.
+AUTHOR_SUGGEST = {
+    'COLLECTIONS': [c for c in os.environ.get('SONNE_AUTHOR_COLLECTIONS', '').split(',') if c],
+    'FIELD': 'author',
+    'MAX_AUTHORS': 1000000,
+    'REFRESH': 3600,
+    'TOP_K': 10,
+    'SCAN_LIMIT': 512,
+}
+
+# records the requests of a share of the connections for `python -m benchmarks.replay`, see
+# solr_channel.lib.recorder. every SANITIZER (a dotted path) may rewrite or drop a request before it is written,
+# `{pid}` in PATH is replaced by the process id. SAMPLE_RATE = 0 disables it.
+RECORDER = {
+    'SAMPLE_RATE': float(os.environ.get('SONNE_RECORD_RATE', 0.0)),
+    'PATH': os.path.join(BASE_DIR, 'recordings', 'rpc-{pid}.jsonl'),
+    'SANITIZERS': ['solr_channel.lib.recorder.drop_graphs'],
+    'MAX_BYTES': 256 * 1024 * 1024,
+}
+
+# sampled request tracing, see solr_channel.lib.tracing
+TRACING = {
+    'SAMPLE_RATE': 0.0,
+    'EXPORTER': 'solr_channel.lib.tracing.LogExporter',
+    'OPTIONS': {'path': os.path.join(BASE_DIR, 'traces.jsonl')},
+}
 
 # Application definition
 
@@ -16,6 +16,10 @@
 from django.contrib import admin
 from django.urls import path
 
+from solr_channel import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', views.metrics),
+    path('metrics/loop', views.loop_lag),
 ]